@@ -6,11 +6,12 @@
 """
 
 import os
-import json
+import importlib.util
+import orjson
+from collections import namedtuple
 from pathlib import Path
-from dotenv import load_dotenv
-
-load_dotenv()
+from types import MappingProxyType, SimpleNamespace
+from dotenv import load_dotenv, dotenv_values
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # 📂 PATHS
@@ -19,6 +20,65 @@ load_dotenv()
 PROJECT_ROOT = Path(__file__).parent
 LOGS_PATH = PROJECT_ROOT / "logs"
 LOGS_PATH.mkdir(exist_ok=True)
+ENV_FILE = PROJECT_ROOT / ".env"
+CONFIG_CACHE_FILE = PROJECT_ROOT / "config_cache.py"
+
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# ⚡ .env + КЭШ КОНФИГА
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+def _write_config_cache(values: dict) -> None:
+    """
+    Сохранить разобранный .env как Python модуль (дальше его подхватит .pyc кэш).
+    В файле TELEGRAM_TOKEN - права только владельцу (.pyc наследует права исходника).
+    """
+    try:
+        fd = os.open(CONFIG_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(
+                "# Сгенерировано config.py из .env - не редактировать, пересоздаётся при изменении .env\n"
+                f"ENV = {values!r}\n"
+            )
+        os.chmod(CONFIG_CACHE_FILE, 0o600)  # Файл мог остаться от старой версии с правами по umask
+    except OSError as e:
+        print(f"⚠️ Не удалось записать кэш конфига: {e}")
+
+
+def _read_config_cache():
+    """Прочитать кэш, если он свежее .env (иначе None)"""
+    if not CONFIG_CACHE_FILE.exists():
+        return None
+    if CONFIG_CACHE_FILE.stat().st_mtime <= ENV_FILE.stat().st_mtime:
+        return None
+    try:
+        spec = importlib.util.spec_from_file_location("config_cache", CONFIG_CACHE_FILE)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return dict(module.ENV)
+    except Exception as e:
+        print(f"⚠️ Кэш конфига повреждён ({e}), перечитываю .env")
+        return None
+
+
+def _load_env() -> None:
+    """
+    Загрузить .env в окружение (как load_dotenv: уже заданные переменные не трогаем).
+    При CONFIG_CACHE=true разобранные значения кэшируются в config_cache.py.
+    """
+    if not ENV_FILE.exists() or os.getenv("CONFIG_CACHE", "true").lower() != "true":
+        load_dotenv()
+        return
+
+    values = _read_config_cache()
+    if values is None:
+        values = {k: v for k, v in dotenv_values(ENV_FILE).items() if v is not None}
+        _write_config_cache(values)
+
+    for key, value in values.items():
+        os.environ.setdefault(key, value)
+
+
+_load_env()
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # 🤖 TELEGRAM
@@ -40,6 +100,7 @@ LLM_MODEL = os.getenv("LLM_MODEL", "neural-chat")
 LLM_NUM_PREDICT = int(os.getenv("LLM_NUM_PREDICT", "2000"))
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.3"))
 LLM_TOP_K = int(os.getenv("LLM_TOP_K", "3"))
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")  # Сколько Ollama держит модель (и KV кэш) в памяти
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # 🎯 РЕЖИМЫ - ДИНАМИЧЕСКИЙ КОНФИГ ИЗ .env
@@ -52,9 +113,9 @@ def _parse_mode_config(env_var: str, default: dict) -> dict:
         return default
     try:
         value = value.strip().strip("'\"")
-        parsed = json.loads(value)
+        parsed = orjson.loads(value)
         return {**default, **parsed}
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"⚠️ Ошибка парсинга {env_var}: {e}, используется дефолт")
         return default
 
@@ -92,40 +153,59 @@ _DYNAMIC_MODES = {
     "detailed": _parse_mode_config("MODE_DETAILED", _DEFAULT_DETAILED),
 }
 
-# РАСШИРЕННЫЙ конфиг с метаданными для RAG
-MODE_CONFIGS = {
+# Метаданные режимов для RAG
+_MODE_METADATA = {
     "short": {
-        **_DYNAMIC_MODES["short"],
         "name": "Кратко",
         "description": "2-3 предложения",
         "target_length": 100,
         "min_length": 50,
         "max_length": 200,
+        "context_chars": 5000,  # Бюджет контекста для LLM (~1500 токенов)
     },
     "default": {
-        **_DYNAMIC_MODES["default"],
         "name": "Нормально",
         "description": "800-1000 слов",
         "target_length": 900,
         "min_length": 500,
         "max_length": 1500,
+        "context_chars": 10500,  # Бюджет контекста для LLM (~3000 токенов)
     },
     "detailed": {
-        **_DYNAMIC_MODES["detailed"],
         "name": "Подробно",
         "description": "1500-2500 слов",
         "target_length": 2000,
         "min_length": 1200,
         "max_length": 3500,
+        "context_chars": 21000,  # Бюджет контекста для LLM (~6000 токенов)
     },
 }
 
+ModeConfig = namedtuple(
+    "ModeConfig",
+    "num_predict temperature top_k db_search web_search web_search_results "
+    "name description target_length min_length max_length context_chars",
+)
+
+
+def _build_mode_config(mode: str) -> ModeConfig:
+    """Собрать неизменяемый конфиг режима (лишние ключи из .env игнорируются)"""
+    merged = {**_DYNAMIC_MODES[mode], **_MODE_METADATA[mode]}
+    return ModeConfig(**{field: merged[field] for field in ModeConfig._fields})
+
+
+# РАСШИРЕННЫЙ конфиг с метаданными для RAG (только чтение)
+MODE_CONFIGS = MappingProxyType({mode: _build_mode_config(mode) for mode in _DYNAMIC_MODES})
+
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # 🌐 WEB SEARCH
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 WEB_SEARCH_TIMEOUT = int(os.getenv("WEB_SEARCH_TIMEOUT", "8"))
 WEB_SEARCH_RESULTS = int(os.getenv("WEB_SEARCH_RESULTS", "5"))
+# Лимиты одновременных запросов к поисковикам (защита от rate limit)
+WEB_SEARCH_CONCURRENCY = int(os.getenv("WEB_SEARCH_CONCURRENCY", "10"))
+WEB_SEARCH_PER_ENGINE = int(os.getenv("WEB_SEARCH_PER_ENGINE", "4"))
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # 📊 LOGGING
@@ -159,15 +239,43 @@ CHROMA_SIMILARITY_THRESHOLD = float(os.getenv("CHROMA_SIMILARITY_THRESHOLD", "0.
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
 EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "10"))
 EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1000"))
+EMBEDDING_CACHE_PERSIST = os.getenv("EMBEDDING_CACHE_PERSIST", "true").lower() == "true"
+EMBEDDING_CACHE_FILE = LOGS_PATH / "embed_cache.pkl"
 DB_AUTO_ADD_SOURCES = os.getenv("DB_AUTO_ADD_SOURCES", "true").lower() == "true"
 DB_CLEANUP_DAYS = int(os.getenv("DB_CLEANUP_DAYS", "60"))
 DB_AUTO_CLEANUP = os.getenv("DB_AUTO_CLEANUP", "false").lower() == "true"
+# Уверенное попадание в БД (top-1 similarity >= порога) - web поиск не нужен
+DB_CONFIDENT_SIMILARITY = float(os.getenv("DB_CONFIDENT_SIMILARITY", "0.85"))
+# Достаточно длинный релевантный контекст из БД - web поиск тоже не нужен
+DB_SUFFICIENT_CONTEXT_CHARS = int(os.getenv("DB_SUFFICIENT_CONTEXT_CHARS", "1200"))
 
 print(f"✅ CHROMA: path={CHROMA_PATH}, collection={CHROMA_COLLECTION_NAME}, topk={CHROMA_SEARCH_TOPK}")
 print(f"✅ EMBEDDINGS: model={EMBEDDING_MODEL}, batch_size={EMBEDDING_BATCH_SIZE}")
 print(f"✅ DB: similarity_threshold={CHROMA_SIMILARITY_THRESHOLD}, auto_add={DB_AUTO_ADD_SOURCES}")
 print(f"✅ EMBEDDING CACHE: size={EMBEDDING_CACHE_SIZE}")
 
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# 💾 КЭШ ОТВЕТОВ
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+# Семантический кэш: похожий запрос (cosine >= порога) в том же режиме -> готовый ответ
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+
+# Точный кэш ответов LLM (только детерминированные вызовы: temperature=0 или cacheable=True)
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+
+# Постоянный кэш ответов (SQLite): точное совпадение (режим, нормализованный запрос)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_FILE = LOGS_PATH / "response_cache.db"
+
+# Кэш результатов веб-поиска в памяти: повтор запроса не ходит в интернет
+WEB_CACHE_SIZE = int(os.getenv("WEB_CACHE_SIZE", "512"))
+WEB_CACHE_TTL = int(os.getenv("WEB_CACHE_TTL", "1800"))
+
 # ═══════════════════════════════════════════════════════════════════════
 # 🛡️ VALIDATION CONFIG - параметры многоуровневой валидации
 # ═══════════════════════════════════════════════════════════════════════
@@ -191,6 +299,12 @@ VALIDATION_CONFIG = {
     'log_context': True,                # Логировать полный контекст в DEBUG
 }
 
+# Атрибутный доступ: VALIDATION.min_context_length (словарь выше оставлен для совместимости)
+VALIDATION = SimpleNamespace(**VALIDATION_CONFIG)
+
+# Производные значения считаем один раз
+_MIN_OVERLAP_PCT = VALIDATION.min_overlap * 100
+
 # ═══════════════════════════════════════════════════════════════════════
 # 🎨 ФУНКЦИИ ДЛЯ ВЫВОДА КОНФИГА
 # ═══════════════════════════════════════════════════════════════════════
@@ -212,17 +326,17 @@ def print_config():
     print("\n📋 РЕЖИМЫ (переопределяются через .env):")
     for mode_name, config in MODE_CONFIGS.items():
         print(f"\n [{mode_name.upper()}]")
-        print(f" • Описание: {config['description']}")
-        print(f" • Макс токенов: {config['num_predict']}")
-        print(f" • Температура: {config['temperature']}")
-        print(f" • Top-K: {config['top_k']}")
-        print(f" • Поиск в БД: {'✅' if config.get('db_search') else '❌'}")
-        print(f" • Веб-поиск: {'✅' if config.get('web_search') else '❌'}")
-        print(f" • Целевой размер: {config.get('target_length', 'N/A')} символов")
+        print(f" • Описание: {config.description}")
+        print(f" • Макс токенов: {config.num_predict}")
+        print(f" • Температура: {config.temperature}")
+        print(f" • Top-K: {config.top_k}")
+        print(f" • Поиск в БД: {'✅' if config.db_search else '❌'}")
+        print(f" • Веб-поиск: {'✅' if config.web_search else '❌'}")
+        print(f" • Целевой размер: {config.target_length} символов")
     
     print("\n🛡️ ВАЛИДАЦИЯ:")
-    print(f" • Min context: {VALIDATION_CONFIG['min_context_length']} chars")
-    print(f" • Min overlap: {VALIDATION_CONFIG['min_overlap']*100:.0f}%")
-    print(f" • Log prompts: {'✅' if VALIDATION_CONFIG['log_full_prompt'] else '❌'}")
+    print(f" • Min context: {VALIDATION.min_context_length} chars")
+    print(f" • Min overlap: {_MIN_OVERLAP_PCT:.0f}%")
+    print(f" • Log prompts: {'✅' if VALIDATION.log_full_prompt else '❌'}")
     
     print("=" * 70 + "\n")
\ No newline at end of file
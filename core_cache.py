@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+💾 CACHE - LRU кэш с временем жизни записей и постоянный кэш в SQLite
+"""
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class TTLCache:
+    """LRU кэш с ограничением размера и TTL (для одного event loop, без блокировок)"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Получить значение (просроченные записи удаляются)"""
+        item = self._data.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value) -> None:
+        """Сохранить значение (самые давно неиспользуемые вытесняются)"""
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    """Постоянный key-value кэш с TTL в SQLite (переживает перезапуск бота)"""
+
+    def __init__(self, path, ttl: float):
+        self.path = str(path)
+        self.ttl = ttl
+        # Одно соединение на всё время работы: вызовы идут из пула потоков
+        # (asyncio.to_thread), поэтому доступ к нему - под блокировкой
+        self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        """Общее соединение с транзакцией на операцию (можно вызывать из любого потока)"""
+        with self._lock:
+            with self._conn:  # commit / rollback
+                yield self._conn
+
+    def close(self) -> None:
+        """Закрыть соединение (вызывается при остановке бота)"""
+        with self._lock:
+            self._conn.close()
+
+    def get(self, key: str, default=None):
+        """Получить значение (просроченные записи удаляются)"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, created_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return default
+            value, created_at = row
+            if time.time() - created_at < self.ttl:
+                return value
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        return default
+
+    def set(self, key: str, value: str) -> None:
+        """Сохранить значение"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+
+    def purge_expired(self) -> int:
+        """Удалить все просроченные записи -> сколько удалено"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl,)
+            )
+            return cursor.rowcount
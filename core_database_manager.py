@@ -4,9 +4,13 @@
 """
 
 import chromadb
+import numpy as np
 from pathlib import Path
+from collections import Counter
 from datetime import datetime, timedelta
-import uuid
+from functools import lru_cache
+import hashlib
+import time
 import asyncio
 from config import (
     CHROMA_PATH,
@@ -18,6 +22,22 @@ from logger import get_logger
 
 logger = get_logger(__name__)
 
+
+@lru_cache(maxsize=1)
+def _get_chroma_client(path: str):
+    """Один PersistentClient на процесс (повторные DatabaseManager не открывают индекс заново)"""
+    return chromadb.PersistentClient(path=path)
+
+
+def _clean_document(doc):
+    """Текст документа + его UTF-8 байты (для id), либо None если текст слишком короткий"""
+    text = doc.get('text', str(doc)) if isinstance(doc, dict) else str(doc)
+    text = text.strip() if text else ""
+    if len(text) <= 10:
+        return None
+    return text, text.encode('utf-8')
+
+
 class DatabaseManager:
     """Менеджер для работы с Chroma БД"""
 
@@ -32,7 +52,7 @@ class DatabaseManager:
             Path(CHROMA_PATH).mkdir(parents=True, exist_ok=True)
             
             # Инициализируем Chroma клиент
-            self.client = chromadb.PersistentClient(path=CHROMA_PATH)
+            self.client = _get_chroma_client(CHROMA_PATH)
             
             # Получаем или создаём коллекцию
             self.collection = self.client.get_or_create_collection(
@@ -46,6 +66,12 @@ class DatabaseManager:
             # write_lock для безопасной конкурентности
             self.write_lock = asyncio.Lock()
             
+            # Кэш числа документов (обновляется под write_lock), чтобы не дергать count() на каждый поиск
+            self._doc_count = self.collection.count()
+            
+            # Старые документы хранят timestamp ISO-строкой - переводим в epoch при первой чистке
+            self._timestamps_migrated = False
+            
             logger.info(f"✅ БД инициализирована: {CHROMA_COLLECTION_NAME}")
             
             stats = self.get_stats()
@@ -55,10 +81,11 @@ class DatabaseManager:
             logger.error(f"❌ Ошибка инициализации БД: {e}", exc_info=True)
             raise
 
-    async def add_documents(self, documents: list, source: str = "manual") -> bool:
+    async def add_documents(self, documents: list, source: str = "manual", batch_size: int = 32) -> bool:
         """
         Добавить документы в БД (с блокировкой для одновременных запросов)
         ✅ ASYNC метод для правильной конкурентности
+        batch_size - сколько текстов эмбеддить за один вызов модели
         """
         if not documents:
             return False
@@ -66,18 +93,10 @@ class DatabaseManager:
         # Блокируем запись если идет другая операция записи
         async with self.write_lock:
             try:
-                # Убедимся что documents это список dict с 'text'
-                processed_docs = []
-                for doc in documents:
-                    if isinstance(doc, dict):
-                        text = doc.get('text', str(doc))
-                    else:
-                        text = str(doc)
+                # Убедимся что documents это список dict с 'text' (один проход: strip + фильтр)
+                cleaned_docs = list(filter(None, map(_clean_document, documents)))
                         
-                    if text and len(text.strip()) > 10:
-                        processed_docs.append(text.strip())
-                        
-                if not processed_docs:
+                if not cleaned_docs:
                     logger.warning("⚠️ Нет валидных документов для добавления")
                     return False
                     
@@ -86,33 +105,55 @@ class DatabaseManager:
                     logger.error("❌ Embeddings service не инициализирован")
                     return False
                     
-                embeddings = self.embeddings_service.embed_batch(processed_docs)
+                # IDs по содержимому: одинаковый текст -> тот же id (повторная загрузка идемпотентна)
+                unique_docs = {
+                    hashlib.blake2b(raw, digest_size=16).hexdigest(): text
+                    for text, raw in cleaned_docs
+                }
+                
+                # Уже сохранённые документы не эмбеддим повторно
+                existing = await asyncio.to_thread(
+                    self.collection.get, ids=list(unique_docs), include=[]
+                )
+                for doc_id in existing['ids']:
+                    unique_docs.pop(doc_id, None)
+                    
+                if not unique_docs:
+                    logger.info(f"ℹ️ Все документы уже есть в БД (source={source})")
+                    return True
+                    
+                ids = list(unique_docs)
+                processed_docs = list(unique_docs.values())
                 
-                if not embeddings or len(embeddings) != len(processed_docs):
+                embeddings = await asyncio.to_thread(
+                    self.embeddings_service.embed_batch, processed_docs, batch_size
+                )
+                
+                if len(embeddings) != len(processed_docs):
                     logger.error("❌ Ошибка при генерации embeddings")
                     return False
                     
-                # Генерируем IDs
-                ids = [str(uuid.uuid4()) for _ in processed_docs]
-                
-                # Метаданные
+                # Метаданные (одна метка времени на весь батч - документы добавлены вместе)
+                ts = int(time.time())
                 metadatas = [
                     {
                         "source": source,
-                        "timestamp": datetime.now().isoformat(),
+                        "timestamp": ts,
                         "length": len(doc)
                     }
                     for doc in processed_docs
                 ]
                 
-                # Добавляем в Chroma (это синхронная операция внутри Chroma)
-                self.collection.add(
+                # Добавляем в Chroma (синхронная операция - выполняем в потоке)
+                await asyncio.to_thread(
+                    self.collection.upsert,
                     ids=ids,
-                    embeddings=embeddings,
+                    embeddings=embeddings.tolist(),
                     documents=processed_docs,
                     metadatas=metadatas
                 )
                 
+                self._doc_count += len(processed_docs)
                 logger.info(f"✅ Добавлено {len(processed_docs)} документов (source={source})")
                 return True
                 
@@ -120,53 +161,94 @@ class DatabaseManager:
                 logger.error(f"❌ Ошибка добавления документов: {e}", exc_info=True)
                 return False
 
-    def search(self, query: str, top_k: int = 5) -> str:
+    async def search(self, query: str, top_k: int = 5) -> tuple:
         """
         Поиск в БД с фильтрацией и форматированием в строку
+        ✅ ASYNC: embedding и запрос к Chroma идут в потоках, event loop не блокируется
+        Возвращает (текст, similarity лучшего документа)
         """
         try:
             if not query or not query.strip():
-                return ""
+                return "", 0.0
                 
             # Проверка на пустую БД
-            if self.collection.count() == 0:
-                return ""
+            if self._doc_count == 0:
+                return "", 0.0
                 
-            query_embedding = self.embeddings_service.embed([query])
-            if not query_embedding or not query_embedding[0]:
-                return ""
+            query_embedding = await asyncio.to_thread(self.embeddings_service.embed, [query])
+            if not len(query_embedding):
+                return "", 0.0
                 
-            query_embedding = query_embedding[0]
+            return await self.search_by_embedding(query_embedding[0], top_k=top_k)
+            
+        except Exception as e:
+            logger.error(f"DB search error: {e}")
+            return "", 0.0
+
+    async def search_by_embedding(self, query_embedding, top_k: int = 5) -> tuple:
+        """
+        Поиск в БД по готовому embedding запроса (без повторного вызова модели)
+        Возвращает (текст, similarity лучшего документа)
+        """
+        try:
+            if self._doc_count == 0 or query_embedding is None or not query_embedding.any():
+                return "", 0.0
             
             # Поиск в Chroma
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
+            results = await asyncio.to_thread(
+                self.collection.query,
+                query_embeddings=[query_embedding.tolist()],
                 n_results=top_k,
             )
             
             if not results or not results['documents'] or not results['documents'][0]:
-                return ""
+                return "", 0.0
                 
             # Сборка контекста с фильтрацией по релевантности
-            valid_docs = []
-            for i, doc in enumerate(results['documents'][0]):
-                distance = results['distances'][0][i] if 'distances' in results else 0
-                similarity = 1 - distance
-                
-                # ✅ ФИЛЬТР релевантности: только документы с similarity >= 0.35
-                # Для cosine distance это 0.35 = хороший порог
-                if similarity >= 0.35:
-                    meta = results['metadatas'][0][i] if 'metadatas' in results else {}
-                    source = meta.get('source', 'unknown')
-                    valid_docs.append(f"[Источник: {source}]\n{doc}")
-                else:
-                    logger.debug(f"Skipped low similarity doc: {similarity:.3f}")
+            # ✅ ФИЛЬТР релевантности: только документы с similarity >= 0.35
+            # Для cosine distance это 0.35 = хороший порог
+            docs = results['documents'][0]
+            metas = (results.get('metadatas') or [[{}] * len(docs)])[0]
+            dists = np.asarray(results['distances'][0], dtype=np.float32)
+            sims = 1.0 - dists
+            keep = np.flatnonzero(sims >= 0.35)
+
+            if len(keep) < len(dists):
+                logger.debug("Skipped %d low similarity docs", len(dists) - len(keep))
+
+            valid_docs = [
+                f"[Источник: {metas[i].get('source', 'unknown')}]\n{docs[i]}"
+                for i in keep
+            ]
                     
-            return "\n\n".join(valid_docs)
+            return "\n\n".join(valid_docs), float(sims.max())
             
         except Exception as e:
             logger.error(f"DB search error: {e}")
-            return ""
+            return "", 0.0
+
+    def _migrate_legacy_timestamps(self) -> int:
+        """
+        Перевести ISO-строки timestamp (старые версии) в epoch int,
+        иначе фильтр $lt их не видит и они никогда не удаляются -> сколько обновлено
+        """
+        all_docs = self.collection.get(include=["metadatas"])
+        ids, metadatas = [], []
+        for doc_id, meta in zip(all_docs['ids'], all_docs.get('metadatas') or []):
+            ts = (meta or {}).get('timestamp')
+            if not isinstance(ts, str):
+                continue
+            try:
+                epoch = int(datetime.fromisoformat(ts).timestamp())
+            except ValueError:
+                logger.warning(f"⚠️ Некорректный timestamp '{ts}' у документа {doc_id}")
+                continue
+            ids.append(doc_id)
+            metadatas.append({**meta, 'timestamp': epoch})
+        
+        if ids:
+            self.collection.update(ids=ids, metadatas=metadatas)
+        return len(ids)
 
     async def delete_old_documents(self, days: int = 60) -> int:
         """
@@ -174,24 +256,27 @@ class DatabaseManager:
         """
         async with self.write_lock:
             try:
-                cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
+                if not self._timestamps_migrated:
+                    migrated = await asyncio.to_thread(self._migrate_legacy_timestamps)
+                    self._timestamps_migrated = True
+                    if migrated:
+                        logger.info(f"🔄 Timestamp {migrated} старых документов переведён в epoch")
+                
+                cutoff = int((datetime.now() - timedelta(days=days)).timestamp())
                 
-                # Получаем все документы и фильтруем
-                all_docs = self.collection.get()
-                if not all_docs or not all_docs.get('ids'):
-                    return 0
+                # Фильтрация внутри Chroma - без выгрузки всей коллекции в Python
+                before = await asyncio.to_thread(self.collection.count)
+                await asyncio.to_thread(
+                    self.collection.delete, where={"timestamp": {"$lt": cutoff}}
+                )
+                self._doc_count = await asyncio.to_thread(self.collection.count)
+                deleted = before - self._doc_count
                     
-                old_ids = []
-                for i, metadata in enumerate(all_docs.get('metadatas', [])):
-                    if metadata.get('timestamp', '') < cutoff_date:
-                        old_ids.append(all_docs['ids'][i])
-                        
-                if old_ids:
-                    self.collection.delete(ids=old_ids)
-                    logger.info(f"🧹 Удалено {len(old_ids)} старых документов (>{days} дней)")
-                    return len(old_ids)
+                if deleted:
+                    logger.info(f"🧹 Удалено {deleted} старых документов (>{days} дней)")
+                    return deleted
                     
-                logger.debug(f"ℹ️ Нет документов старше {days} дней")
+                logger.debug("ℹ️ Нет документов старше %d дней", days)
                 return 0
                 
             except Exception as e:
@@ -219,19 +304,20 @@ class DatabaseManager:
     def clear(self) -> bool:
         """Очистить БД полностью"""
         try:
-            all_docs = self.collection.get()
+            all_docs = self.collection.get(include=[])
             if all_docs and all_docs.get('ids'):
                 self.collection.delete(ids=all_docs['ids'])
+                self._doc_count = 0
                 logger.warning(f"🗑️ БД очищена ({len(all_docs['ids'])} документов удалено)")
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка очистки БД: {e}", exc_info=True)
             return False
 
-    def get_collection_info(self) -> dict:
+    async def get_collection_info(self) -> dict:
         """Получить детальную информацию о коллекции"""
         try:
-            all_docs = self.collection.get()
+            all_docs = await asyncio.to_thread(self.collection.get, include=["metadatas"])
             if not all_docs or not all_docs.get('ids'):
                 return {
                     'total': 0,
@@ -240,25 +326,28 @@ class DatabaseManager:
                     'newest': None,
                 }
                 
-            # Считаем по источникам
-            sources = {}
-            timestamps = []
+            metadatas = all_docs.get('metadatas') or []
             
-            for metadata in all_docs.get('metadatas', []):
-                source = metadata.get('source', 'unknown')
-                sources[source] = sources.get(source, 0) + 1
-                
-                ts = metadata.get('timestamp')
-                if ts:
-                    timestamps.append(ts)
+            # Считаем по источникам, oldest/newest - в том же проходе
+            sources = Counter()
+            oldest = newest = None
             
-            timestamps.sort()
+            for meta in metadatas:
+                sources[meta.get('source', 'unknown')] += 1
+                
+                # Старые записи хранили ISO-строку - их не смешиваем с epoch
+                ts = meta.get('timestamp')
+                if isinstance(ts, int):
+                    if oldest is None or ts < oldest:
+                        oldest = ts
+                    if newest is None or ts > newest:
+                        newest = ts
             
             return {
                 'total': len(all_docs['ids']),
-                'sources': sources,
-                'oldest': timestamps[0] if timestamps else None,
-                'newest': timestamps[-1] if timestamps else None,
+                'sources': dict(sources),
+                'oldest': oldest,
+                'newest': newest,
             }
         except Exception as e:
             logger.error(f"❌ Ошибка получения информации: {e}")
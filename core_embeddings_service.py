@@ -4,108 +4,273 @@
 🔢 EMBEDDINGS SERVICE - Генерация embeddings через Ollama
 """
 
+import hashlib
+import ipaddress
+import os
+import pickle
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import numpy as np
+import orjson
 import requests
-from config import OLLAMA_HOST, EMBEDDING_MODEL, REQUEST_TIMEOUT, EMBEDDING_CACHE_SIZE
+from requests.adapters import HTTPAdapter
+from config import (
+    OLLAMA_HOST,
+    EMBEDDING_MODEL,
+    EMBEDDING_BATCH_SIZE,
+    REQUEST_TIMEOUT,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_PERSIST,
+    EMBEDDING_CACHE_FILE,
+    MAX_WORKERS,
+)
 from logger import get_logger
 
 logger = get_logger(__name__)
 
+
+def _resolve_host(url: str) -> str:
+    """Подставить IP вместо имени хоста в http:// URL (один DNS lookup при старте)"""
+    parsed = urlparse(url)
+    host = parsed.hostname
+    # https не трогаем - сертификат выдан на имя, а не на IP
+    if parsed.scheme != "http" or not host:
+        return url
+
+    try:
+        ipaddress.ip_address(host)
+        return url  # Уже IP
+    except ValueError:
+        pass
+
+    try:
+        ip = socket.gethostbyname(host)
+    except OSError:
+        return url
+
+    netloc = ip if parsed.port is None else f"{ip}:{parsed.port}"
+    return parsed._replace(netloc=netloc).geturl()
+
+
 class EmbeddingsService:
     """Сервис для генерации embeddings"""
 
     def __init__(self):
         """Инициализация"""
         logger.info(f"🔢 Инициализирую EmbeddingsService (модель={EMBEDDING_MODEL})...")
-        self.host = OLLAMA_HOST
+        self.host = _resolve_host(OLLAMA_HOST)
         self.model = EMBEDDING_MODEL
-        self.endpoint = f"{self.host}/api/embeddings"
+        self.endpoint = f"{self.host}/api/embed"
+        self.legacy_endpoint = f"{self.host}/api/embeddings"
+        self.batch_size = EMBEDDING_BATCH_SIZE
+        self.dim = 384  # Уточняется по первому успешному ответу модели
+
+        # Одна сессия на сервис - keep-alive вместо нового TCP на каждый запрос
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS * 2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Пул для параллельных запросов по одному тексту (если /api/embed недоступен)
+        self._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="embeddings")
+        self._batch_api = True
         
         # LRU cache для часто используемых embeddings
-        self._embed_cache = {}
+        self._embed_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
         self.cache_size = EMBEDDING_CACHE_SIZE
+        if EMBEDDING_CACHE_PERSIST:
+            self._load_cache()
         logger.info(f"✅ EmbeddingsService инициализирована")
 
-    def embed(self, texts: list) -> list:
-        """Генерирует embeddings для списка текстов"""
+    @staticmethod
+    def _cache_key(text: str):
+        """
+        Ключ кэша: сам текст, для длинных текстов - blake2b digest.
+        В отличие от hash() ключи одинаковы между запусками, поэтому кэш можно сохранять на диск.
+        """
+        if len(text) < 256:
+            return text
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def embed(self, texts: list) -> np.ndarray:
+        """
+        Генерирует embeddings для списка текстов -> массив (N, dim) float32.
+        RuntimeError, если хотя бы для одного текста embedding получить не удалось
+        (удачные при этом уже в кэше - повтор запросит только неудавшиеся).
+        """
         if not texts:
-            return []
+            return np.empty((0, self.dim), dtype=np.float32)
         
         embeddings = [None] * len(texts)  # Заранее создаем список нужного размера
-        uncached = []
-        uncached_indices = []
+        uncached = {}  # текст -> позиции во входном списке (дубликаты запрашиваем один раз)
         
         # Проверяем кэш
-        for i, text in enumerate(texts):
-            text_hash = hash(text)
-            if text_hash in self._embed_cache:
-                embeddings[i] = self._embed_cache[text_hash]
-            else:
-                uncached.append(text)
-                uncached_indices.append(i)
+        with self._cache_lock:
+            for i, text in enumerate(texts):
+                key = self._cache_key(text)
+                if key in self._embed_cache:
+                    self._embed_cache.move_to_end(key)
+                    embeddings[i] = self._embed_cache[key]
+                else:
+                    uncached.setdefault(text, []).append(i)
         
         # Генерируем embeddings для некэшированных текстов
         if uncached:
-            new_embeddings = self._call_ollama(uncached)
+            unique_texts = list(uncached)
+            new_embeddings = self._call_ollama(unique_texts)
+            failed = 0
             
-            # Добавляем в результат и кэш
-            for idx, embedding in zip(uncached_indices, new_embeddings):
-                text_hash = hash(texts[idx])
-                self._embed_cache[text_hash] = embedding
-                embeddings[idx] = embedding  # Вставляем в правильную позицию
-                
-                # Ограничиваем размер кэша
-                if len(self._embed_cache) > self.cache_size:
-                    oldest_key = next(iter(self._embed_cache))
-                    del self._embed_cache[oldest_key]
+            # Добавляем в результат и кэш (неудачные тексты в кэш не попадают)
+            with self._cache_lock:
+                for text, embedding in zip(unique_texts, new_embeddings):
+                    if embedding is None:
+                        failed += 1
+                        continue
+                    self._embed_cache[self._cache_key(text)] = embedding
+                    for idx in uncached[text]:
+                        embeddings[idx] = embedding  # Вставляем во все позиции текста
+                    
+                    # Ограничиваем размер кэша (вытесняем давно неиспользуемые)
+                    if len(self._embed_cache) > self.cache_size:
+                        self._embed_cache.popitem(last=False)
+            
+            if failed:
+                raise RuntimeError(
+                    f"не удалось получить embeddings для {failed} из {len(unique_texts)} текстов"
+                )
         
-        return embeddings
+        return np.stack(embeddings)
 
-    def embed_batch(self, texts: list, batch_size: int = 32) -> list:
+    def embed_batch(self, texts: list, batch_size: int = 32) -> np.ndarray:
         """Генерирует embeddings батчами"""
-        all_embeddings = []
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            batch_embeddings = self.embed(batch)
-            all_embeddings.extend(batch_embeddings)
-        
-        return all_embeddings
+        if not texts:
+            return np.empty((0, self.dim), dtype=np.float32)
+
+        return np.concatenate([
+            self.embed(texts[i:i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ])
 
     def _call_ollama(self, texts: list) -> list:
-        """Вызывает Ollama API для генерации embeddings"""
-        try:
-            embeddings = []
-            for text in texts:
-                payload = {
-                    "model": self.model,
-                    "prompt": text,
-                }
-                
+        """
+        Вызывает Ollama API для генерации embeddings (батчами через /api/embed)
+        -> список векторов в порядке texts, None для текстов с ошибкой
+        """
+        rows = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i:i + self.batch_size]
+            if self._batch_api:
                 try:
-                    response = requests.post(
-                        self.endpoint,
-                        json=payload,
-                        timeout=REQUEST_TIMEOUT,
-                    )
-                    
-                    if response.status_code == 200:
-                        result = response.json()
-                        embedding = result.get("embedding", [])
-                        embeddings.append(embedding)
-                    else:
-                        logger.warning(f"⚠️ Embeddings API ошибка: {response.status_code}")
-                        embeddings.append([0.0] * 384)  # Дефолтный embedding
-                
+                    rows.extend(self._embed_request(batch))
+                    continue
                 except Exception as e:
-                    logger.error(f"❌ Ошибка embeddings: {e}")
-                    embeddings.append([0.0] * 384)
-            
-            return embeddings
-        
+                    logger.warning(f"⚠️ Батч embeddings не удался ({e}), пробую по одному")
+                    status = getattr(getattr(e, "response", None), "status_code", None)
+                    if status == 404:
+                        # Старая версия Ollama без /api/embed - больше не пробуем
+                        self._batch_api = False
+
+            rows.extend(self._embed_each(batch))
+
+        return rows
+
+    def _embed_request(self, texts: list) -> np.ndarray:
+        """Один HTTP запрос на весь батч"""
+        payload = {
+            "model": self.model,
+            "input": texts,
+        }
+
+        response = self.session.post(
+            self.endpoint,
+            json=payload,
+            timeout=REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+
+        embeddings = np.asarray(orjson.loads(response.content)["embeddings"], dtype=np.float32)
+        if embeddings.ndim != 2 or len(embeddings) != len(texts):
+            raise ValueError(f"ожидалось {len(texts)} embeddings, получено {len(embeddings)}")
+
+        self.dim = embeddings.shape[1]
+        return embeddings
+
+    def _embed_each(self, texts: list) -> list:
+        """Запросы по одному тексту - параллельно в пуле потоков (порядок сохраняется)"""
+        if len(texts) == 1:
+            return [self._embed_one(texts[0])]
+        return list(self._executor.map(self._embed_one, texts))
+
+    def _embed_one(self, text: str):
+        """Fallback: старый endpoint /api/embeddings для одного текста (None при ошибке)"""
+        payload = {
+            "model": self.model,
+            "prompt": text,
+        }
+
+        try:
+            response = self.session.post(
+                self.legacy_endpoint,
+                json=payload,
+                timeout=REQUEST_TIMEOUT,
+            )
+
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                embedding = np.asarray(data.get("embedding", []), dtype=np.float32)
+                if embedding.size:
+                    self.dim = embedding.size
+                    return embedding
+                return None
+
+            logger.warning(f"⚠️ Embeddings API ошибка: {response.status_code}")
+            return None
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка embeddings: {e}")
+            return None
+
+    def _load_cache(self):
+        """Загрузить сохранённый кэш embeddings (только для той же модели)"""
+        if not EMBEDDING_CACHE_FILE.exists():
+            return
+        try:
+            with open(EMBEDDING_CACHE_FILE, "rb") as f:
+                data = pickle.load(f)
+            if data.get("model") != self.model:
+                logger.info("ℹ️ Кэш embeddings от другой модели, пропускаю")
+                return
+            # Нулевые векторы (ошибки старых версий) - не embeddings, отбрасываем
+            entries = [
+                (key, vec) for key, vec in data["entries"].items() if vec.any()
+            ][-self.cache_size:]
+            self._embed_cache.update(entries)
+            logger.info(f"✅ Загружено {len(entries)} embeddings из кэша")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось загрузить кэш embeddings: {e}")
+
+    def save_cache(self):
+        """Сохранить кэш embeddings на диск (вызывается при остановке бота)"""
+        if not EMBEDDING_CACHE_PERSIST:
+            return
+        with self._cache_lock:
+            data = {"model": self.model, "entries": OrderedDict(self._embed_cache)}
+        try:
+            tmp_path = EMBEDDING_CACHE_FILE.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, EMBEDDING_CACHE_FILE)
+            logger.info(f"💾 Кэш embeddings сохранён ({len(data['entries'])} записей)")
         except Exception as e:
-            logger.error(f"❌ Критическая ошибка embeddings: {e}")
-            return [[0.0] * 384 for _ in texts]
+            logger.warning(f"⚠️ Не удалось сохранить кэш embeddings: {e}")
 
     def clear_cache(self):
         """Очистить кэш"""
-        self._embed_cache.clear()
+        with self._cache_lock:
+            self._embed_cache.clear()
         logger.info("✅ Кэш embeddings очищен")
\ No newline at end of file
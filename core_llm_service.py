@@ -4,24 +4,30 @@
 """
 
 import re
-import requests
+import random
+import logging
+import asyncio
+import hashlib
+import aiohttp
+import orjson
+from typing import Final
 from config import (
     OLLAMA_HOST,
     LLM_MODEL,
-    LLM_TEMPERATURE,
-    LLM_TOP_K,
     REQUEST_TIMEOUT,
     MODE_CONFIGS,
+    LLM_CACHE_SIZE,
+    LLM_CACHE_TTL,
+    LLM_KEEP_ALIVE,
 )
+from core_cache import TTLCache
 from logger import get_logger
 
 logger = get_logger(__name__)
 
-
-class LLMService:
-    """LLM сервис с поддержкой динамических режимов и авто-дополнения ответа."""
-
-    SYSTEM_PROMPT = """Ты полезный помощник AI на русском языке.
+# Системный промпт - всегда первым и всегда одинаковым: Ollama переиспользует KV кэш
+# общего префикса между запросами. Никаких динамических значений внутри!
+SYSTEM_PROMPT: Final[str] = """Ты полезный помощник AI на русском языке.
 
     ГЛАВНОЕ ПРАВИЛО: Всегда отвечай ТОЛЬКО на РУССКОМ языке. Никаких исключений.
 
@@ -38,22 +44,79 @@ class LLMService:
 
     Язык: РУССКИЙ (обязательно)"""
 
+
+class IncompleteAnswerError(RuntimeError):
+    """Поток генерации оборвался на середине ответа (частичный текст - не ответ)"""
+
+
+class LLMService:
+    """LLM сервис с поддержкой динамических режимов и авто-дополнения ответа."""
+
     INCOMPLETE_THRESHOLD = 0.85
     MAX_CONTINUATION_RETRIES = 2
+    MAX_RETRIES = 3
+    CONNECT_TIMEOUT = 10
+    CACHE_STATS_EVERY = 50
+    # Конец предложения: знак + пробел/перевод строки + начало следующего предложения.
+    # Не считаются: "3." и "1." (версии, пункты списка), "т.е." (однобуквенные сокращения)
+    _SENTENCE_END_RE = re.compile(r"(?<!\d)(?<!\b\w)[.!?]+(?=\s*\n|\s+[A-ZА-ЯЁ«\"(\[])")
+    _PROPER_ENDINGS = (".", "!", "?", "```", "`", '"', "»", ")", "]", "}")
+    _TRAILING_WS_RE = re.compile(r"[ \t]+\n")
+    _NEWLINE_RE = re.compile(r"\n{3,}")
 
     def __init__(self):
         self.host = OLLAMA_HOST
         self.model = LLM_MODEL
         self.endpoint = f"{self.host}/api/generate"
+        self._cache = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+        # Без общего лимита: поток DETAILED длится дольше REQUEST_TIMEOUT,
+        # ограничиваем только паузу между фрагментами
+        self.timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=self.CONNECT_TIMEOUT, sock_read=REQUEST_TIMEOUT
+        )
+        # Сессия создаётся лениво - внутри event loop бота
+        self._session = None
         logger.info(f"✅ LLM инициализирована: {self.model} @ {self.host}")
 
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Вернуть общую сессию (создать при первом обращении)"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        """Закрыть сессию (вызывается при остановке бота)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("✅ LLMService: сессия закрыта")
+        self._session = None
+
+    def _cache_key(self, full_prompt: str, max_tokens: int, temperature: float, top_k: int) -> str:
+        """SHA256 от всех параметров, влияющих на ответ"""
+        params = {
+            "model": self.model,
+            "prompt": full_prompt,
+            "num_predict": max_tokens,
+            "temperature": temperature,
+            "top_k": top_k,
+        }
+        return hashlib.sha256(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def _log_cache_stats(self) -> None:
+        lookups = self._cache.hits + self._cache.misses
+        if lookups % self.CACHE_STATS_EVERY == 0:
+            logger.info(
+                f"📊 LLM кэш: hit rate {self._cache.hit_rate*100:.1f}% "
+                f"({self._cache.hits}/{lookups}, записей {len(self._cache)})"
+            )
+
     def _clean_answer(self, text: str) -> str:
         """Легкая очистка вывода модели."""
         if not text:
             return ""
 
-        text = re.sub(r"\n\n\n+", "\n\n", text)
-        text = "\n".join(line.rstrip() for line in text.split("\n"))
+        text = self._TRAILING_WS_RE.sub("\n", text)
+        text = self._NEWLINE_RE.sub("\n\n", text)
         return text.strip()
 
     def _looks_incomplete(self, text: str, max_tokens: int) -> bool:
@@ -62,9 +125,8 @@ class LLMService:
             return False
 
         tail = text.strip()[-40:]
-        proper_endings = (".", "!", "?", "```", "`", '"', "»", ")", "]", "}")
 
-        if any(tail.endswith(e) for e in proper_endings):
+        if tail.endswith(self._PROPER_ENDINGS):
             return False
 
         est_tokens = len(text) / 3.5
@@ -78,58 +140,241 @@ class LLMService:
 
         return False
 
-    def _call_ollama(
+    def _sentence_end(self, text: str, min_length: int, scanned: int):
+        """Позиция конца первого предложения после min_length символов (None - пока нет)"""
+        # Назад от уже просмотренного - на случай, если пробелы после знака пришли раньше
+        start = max(min_length - 1, scanned - 16, 0)
+        match = self._SENTENCE_END_RE.search(text, start)
+        return match.end() if match else None
+
+    async def _stream_ollama(
         self,
         full_prompt: str,
         max_tokens: int,
         temperature: float,
         top_k: int,
-    ) -> str:
-        """Внутренний вызов к Ollama API."""
+        stop_after: int = 0,
+    ):
+        """
+        Потоковый вызов Ollama API: отдаёт фрагменты текста по мере генерации.
+
+        stop_after > 0 - закрыть поток на первом конце предложения после stop_after
+        символов (соединение рвётся, Ollama прекращает генерацию).
+
+        IncompleteAnswerError - если поток оборвался после того, как часть текста
+        уже отдана (повторять запрос в этом случае нельзя).
+        """
         payload = {
             "model": self.model,
             "prompt": full_prompt,
-            "stream": False,
-            "num_predict": max_tokens,
-            "temperature": temperature,
-            "top_k": top_k,
+            "stream": True,
+            "keep_alive": LLM_KEEP_ALIVE,
+            # Параметры сэмплинга Ollama читает только из options
+            "options": {
+                "num_predict": max_tokens,
+                "temperature": temperature,
+                "top_k": top_k,
+            },
         }
 
-        logger.debug(
-            f"🔍 DEBUG: LLM запрос (токенов={max_tokens}, temp={temperature}, top_k={top_k})"
-        )
-
-        try:
-            response = requests.post(
-                self.endpoint,
-                json=payload,
-                timeout=REQUEST_TIMEOUT,
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "🔍 DEBUG: LLM запрос (токенов=%s, temp=%s, top_k=%s)", max_tokens, temperature, top_k
             )
 
-            response.raise_for_status()
-            result = response.json()
-            answer = (result.get("response") or "").strip()
+        length = 0
+        text = ""  # накопленный ответ - нужен только для остановки по stop_after
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                session = await self._get_session()
+                async with session.post(self.endpoint, json=payload) as response:
+                    response.raise_for_status()
+
+                    # Ответ - NDJSON: одна строка {"response": "...", "done": false} на фрагмент
+                    async for line in response.content:
+                        if not line.strip():
+                            continue
+                        data = orjson.loads(line)
+                        chunk = data.get("response") or ""
+
+                        if chunk and stop_after:
+                            # Границу видно только когда пришло начало следующего предложения,
+                            # поэтому ищем в накопленном тексте, включая хвост прошлых фрагментов
+                            prev_len = len(text)
+                            text += chunk
+                            end = self._sentence_end(text, stop_after, prev_len)
+                            if end is not None:
+                                if end > prev_len:
+                                    length += end - prev_len
+                                    yield chunk[:end - prev_len]
+                                response.close()
+                                logger.debug("✂️ Поток остановлен на конце предложения (%d символов)", length)
+                                break
+
+                        if chunk:
+                            length += len(chunk)
+                            yield chunk
+                        if data.get("done"):
+                            break
+
+                if length:
+                    logger.info(f"✅ LLM ответила ({length} символов)")
+                else:
+                    logger.warning("⚠️ LLM вернул пустой response")
+                return
+
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                # Повторяем только если пользователю ещё ничего не отдали
+                if length == 0 and attempt + 1 < self.MAX_RETRIES:
+                    delay = 2 ** attempt + random.random()
+                    logger.warning(
+                        f"🔁 Ollama недоступна ({type(e).__name__}), повтор через {delay:.1f}с"
+                    )
+                    await asyncio.sleep(delay)
+                    continue
+                if length:
+                    logger.error(f"❌ Поток LLM оборвался после {length} символов ({type(e).__name__})")
+                    raise IncompleteAnswerError(f"поток оборвался после {length} символов") from e
+                if isinstance(e, asyncio.TimeoutError):
+                    logger.error("❌ Timeout: Ollama не отвечает")
+                else:
+                    logger.error("❌ ConnectionError: Ollama не запущена")
+                return
+            except Exception as e:
+                logger.error(f"❌ Ошибка LLM: {e}")
+                if length:
+                    raise IncompleteAnswerError(f"поток оборвался после {length} символов") from e
+                return
+
+    async def _call_ollama(
+        self,
+        full_prompt: str,
+        max_tokens: int,
+        temperature: float,
+        top_k: int,
+    ) -> str:
+        """Внутренний вызов к Ollama API (весь ответ целиком)."""
+        chunks = [
+            chunk async for chunk in self._stream_ollama(full_prompt, max_tokens, temperature, top_k)
+        ]
+        return "".join(chunks).strip()
+
+    async def generate_stream(
+        self,
+        prompt: str,
+        context: str = "",
+        mode: str = "default",
+        cacheable: bool = False,
+    ):
+        """
+        Генерировать ответ потоком фрагментов (для постепенного вывода).
 
-            if answer:
-                logger.info(
-                    f"✅ LLM ответила ({len(answer)} символов)"
+        Первый проход отдаётся по мере генерации; дополнения (continuation)
+        приходят целыми блоками. Параметры - как у generate().
+        """
+        if mode not in MODE_CONFIGS:
+            logger.warning(f"⚠️ Неизвестный режим '{mode}', используем 'default'")
+            mode = "default"
+
+        cfg = MODE_CONFIGS[mode]
+        max_tokens = int(cfg.num_predict)
+        top_k = int(cfg.top_k)
+        temperature = float(cfg.temperature)
+
+        if mode == "short":
+            max_tokens = min(max_tokens, 120)
+
+        full_prompt = f"{SYSTEM_PROMPT}\n\n{prompt}"
+
+        # При temperature=0 ответ детерминирован - можно отдать из кэша
+        cache_key = None
+        if cacheable or temperature == 0:
+            cache_key = self._cache_key(full_prompt, max_tokens, temperature, top_k)
+            cached = self._cache.get(cache_key)
+            self._log_cache_stats()
+            if cached is not None:
+                logger.info(f"⚡ LLM cache HIT ({len(cached)} символов)")
+                yield cached
+                return
+
+        # SHORT: не ждём хвост генерации - хватает первых законченных предложений
+        stop_after = int(cfg.min_length) if mode == "short" else 0
+
+        chunks = []
+        async for chunk in self._stream_ollama(full_prompt, max_tokens, temperature, top_k, stop_after):
+            chunks.append(chunk)
+            yield chunk
+
+        answer = self._clean_answer("".join(chunks))
+        if not answer:
+            return
+
+        # Continuation для DEFAULT и DETAILED, но НЕ для SHORT
+        enable_continuation = mode in ["default", "detailed"]
+
+        retries = 0
+        while (
+            enable_continuation
+            and self._looks_incomplete(answer, max_tokens)
+            and retries < self.MAX_CONTINUATION_RETRIES
+        ):
+            retries += 1
+            logger.info(
+                f"🔄 Continuation {retries}/{self.MAX_CONTINUATION_RETRIES} (режим {mode})"
+            )
+            
+            continuation_prompt = (
+                f"{SYSTEM_PROMPT}\n\n"
+                f"[Пользователь просит подробный ответ. "
+                f"Продолжи ответ естественно, без повторений. "
+                f"Если ответ уже закончен логично, просто скажи что он полный.]\n\n"
+                f"ПРЕДЫДУЩИЙ ОТВЕТ (может быть обрезан):\n{answer}"
+            )
+            
+            try:
+                continuation = await self._call_ollama(
+                    full_prompt=continuation_prompt,
+                    max_tokens=max_tokens // 2,
+                    temperature=temperature,
+                    top_k=top_k,
                 )
-            else:
-                logger.warning("⚠️ LLM вернул пустой response")
+            except IncompleteAnswerError:
+                # Обрывок продолжения не добавляем; основной ответ цел, но в кэш не кладём
+                logger.warning("⚠️ Continuation оборвался, отдаём ответ без него")
+                cache_key = None
+                break
+            
+            if not continuation:
+                logger.warning("⚠️ Continuation вернул пустой ответ")
+                break
+            
+            continuation = self._clean_answer(continuation)
+            
+            # Проверяем что continuation не просто повторение старого текста
+            if continuation.lower() in answer.lower() or len(continuation) < 50:
+                logger.info("ℹ️ Continuation повторил текст или слишком короткий, стопим")
+                break
+            
+            answer = f"{answer}\n\n{continuation}"
+            yield f"\n\n{continuation}"
+            logger.info(f"✅ Continuation: добавлено {len(continuation)} символов")
+
+        if retries > 0:
+            logger.info(
+                f"✅ Ответ готов ({len(answer)} символов, режим {mode})"
+            )
 
-            return answer
+        if cache_key:
+            self._cache.set(cache_key, answer)
 
-        except requests.exceptions.Timeout:
-            logger.error("❌ Timeout: Ollama не отвечает")
-            return ""
-        except requests.exceptions.ConnectionError:
-            logger.error("❌ ConnectionError: Ollama не запущена")
-            return ""
-        except Exception as e:
-            logger.error(f"❌ Ошибка LLM: {e}")
-            return ""
-
-    def generate(self, prompt: str, context: str = "", mode: str = "default") -> str:
+    async def generate(
+        self,
+        prompt: str,
+        context: str = "",
+        mode: str = "default",
+        cacheable: bool = False,
+        on_chunk=None,
+    ) -> str:
         """
         Генерировать ответ с динамическими параметрами режима.
 
@@ -137,87 +382,20 @@ class LLMService:
             prompt: основной вопрос
             context: контекст (из БД или веба)
             mode: "short", "default" или "detailed"
+            cacheable: кэшировать ответ даже при temperature > 0
+            on_chunk: async callback(фрагмент) - для постепенного вывода ответа
 
         Returns:
-            str: ответ от LLM
+            str: ответ от LLM ("" при ошибке, в том числе если поток оборвался на середине)
         """
         try:
-            if mode not in MODE_CONFIGS:
-                logger.warning(f"⚠️ Неизвестный режим '{mode}', используем 'default'")
-                mode = "default"
-
-            cfg = MODE_CONFIGS.get(mode, {})
-            max_tokens = int(cfg.get("num_predict", 600))
-            top_k = int(cfg.get("top_k", LLM_TOP_K))
-            temperature = float(cfg.get("temperature", LLM_TEMPERATURE))
-
-            if mode == "short":
-                max_tokens = min(max_tokens, 120)
-
-            full_prompt = f"{self.SYSTEM_PROMPT}\n\n{prompt}"
-
-            answer = self._call_ollama(
-                full_prompt=full_prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_k=top_k,
-            )
-
-            if not answer:
-                return ""
-
-            answer = self._clean_answer(answer)
-
-            # Continuation для DEFAULT и DETAILED, но НЕ для SHORT
-            enable_continuation = mode in ["default", "detailed"]
-
-            retries = 0
-            while (
-                enable_continuation
-                and self._looks_incomplete(answer, max_tokens)
-                and retries < self.MAX_CONTINUATION_RETRIES
-            ):
-                retries += 1
-                logger.info(
-                    f"🔄 Continuation {retries}/{self.MAX_CONTINUATION_RETRIES} (режим {mode})"
-                )
-                
-                continuation_prompt = (
-                    f"{self.SYSTEM_PROMPT}\n\n"
-                    f"[Пользователь просит подробный ответ. "
-                    f"Продолжи ответ естественно, без повторений. "
-                    f"Если ответ уже закончен логично, просто скажи что он полный.]\n\n"
-                    f"ПРЕДЫДУЩИЙ ОТВЕТ (может быть обрезан):\n{answer}"
-                )
-                
-                continuation = self._call_ollama(
-                    full_prompt=continuation_prompt,
-                    max_tokens=max_tokens // 2,
-                    temperature=temperature,
-                    top_k=top_k,
-                )
-                
-                if not continuation:
-                    logger.warning("⚠️ Continuation вернул пустой ответ")
-                    break
-                
-                continuation = self._clean_answer(continuation)
-                
-                # Проверяем что continuation не просто повторение старого текста
-                if continuation.lower() in answer.lower() or len(continuation) < 50:
-                    logger.info("ℹ️ Continuation повторил текст или слишком короткий, стопим")
-                    break
-                
-                answer = f"{answer}\n\n{continuation}"
-                logger.info(f"✅ Continuation: добавлено {len(continuation)} символов")
-
-            if retries > 0:
-                logger.info(
-                    f"✅ Ответ готов ({len(answer)} символов, режим {mode})"
-                )
-
-            return answer
+            chunks = []
+            async for chunk in self.generate_stream(prompt, context, mode, cacheable):
+                chunks.append(chunk)
+                if on_chunk is not None:
+                    await on_chunk(chunk)
+            return self._clean_answer("".join(chunks))
 
         except Exception as e:
             logger.error(f"❌ Ошибка LLM.generate: {e}")
-            return ""
\ No newline at end of file
+            return ""
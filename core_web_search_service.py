@@ -5,18 +5,33 @@
 
 import aiohttp
 import asyncio
+import soupsieve as sv
 from bs4 import BeautifulSoup
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, urlparse
 import random
-from config import WEB_SEARCH_TIMEOUT, WEB_SEARCH_RESULTS
+from types import MappingProxyType
+from config import (
+    WEB_SEARCH_TIMEOUT,
+    WEB_SEARCH_RESULTS,
+    WEB_SEARCH_CONCURRENCY,
+    WEB_SEARCH_PER_ENGINE,
+)
 from logger import get_logger
 
 logger = get_logger(__name__)
 
+# CSS селекторы компилируются один раз при импорте
+_ROW_SELECTOR = sv.compile('tr:has(td a)')          # DDG Lite: строки с результатами
+_BING_SELECTOR = sv.compile('li.b_algo')
+_GOOGLE_SELECTOR = sv.compile('div.g')
+_GOOGLE_SNIPPET_SELECTOR = sv.compile('div.s, span.st')
+
 
 class WebSearchService:
     """Асинхронный сервис поиска в интернете"""
 
+    MAX_RETRIES = 3
+
     def __init__(self):
         logger.info("✅ WebSearchService инициализирована")
         self.timeout = aiohttp.ClientTimeout(total=WEB_SEARCH_TIMEOUT)
@@ -26,39 +41,104 @@ class WebSearchService:
             'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
             'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36',
         ]
+        # Готовые (неизменяемые) наборы заголовков - по одному на User-Agent
+        self._header_variants = tuple(
+            MappingProxyType({
+                'User-Agent': ua,
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Language': 'ru-RU,ru;q=0.9',
+                'DNT': '1',
+            })
+            for ua in self.user_agents
+        )
+        # Общая сессия с пулом соединений (keep-alive, кэш DNS) - создаётся лениво,
+        # т.к. connector должен принадлежать event loop бота
+        self._connector = None
+        self._session = None
+        # Общий лимит исходящих запросов + отдельный на каждый поисковик
+        self._sem = asyncio.Semaphore(WEB_SEARCH_CONCURRENCY)
+        self._engine_sems = {
+            engine: asyncio.Semaphore(WEB_SEARCH_PER_ENGINE)
+            for engine in ("DuckDuckGo", "Bing", "Google")
+        }
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Вернуть общую сессию (создать при первом обращении)"""
+        if self._session is None or self._session.closed:
+            self._connector = aiohttp.TCPConnector(limit=50, limit_per_host=10, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=self._connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        """Закрыть сессию (вызывается при остановке бота)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("✅ WebSearchService: сессия закрыта")
+        self._session = None
+        self._connector = None
+
+    async def _limited(self, engine: str, search_fn, query: str) -> list:
+        """Запрос к поисковику в пределах лимитов одновременности"""
+        engine_sem = self._engine_sems[engine]
+        if engine_sem.locked() or self._sem.locked():
+            logger.warning(f"⏳ Лимит web запросов исчерпан ({engine}), жду очереди...")
+        async with engine_sem, self._sem:
+            return await search_fn(query)
+
+    async def _fetch(self, method: str, url: str, **kwargs):
+        """
+        HTTP запрос к поисковику -> HTML (None если не 200).
+        429 и 5xx повторяются с экспоненциальной задержкой и jitter.
+        """
+        session = await self._get_session()
+        for attempt in range(self.MAX_RETRIES):
+            async with session.request(method, url, headers=self._get_headers(), **kwargs) as response:
+                if response.status == 200:
+                    return await response.text()
+                if response.status != 429 and response.status < 500:
+                    return None
+
+            if attempt + 1 < self.MAX_RETRIES:
+                delay = 2 ** attempt + random.random()
+                logger.warning(
+                    f"🔁 {urlparse(url).netloc}: HTTP {response.status}, повтор через {delay:.1f}с"
+                )
+                await asyncio.sleep(delay)
+
+        return None
 
     def _get_headers(self):
-        return {
-            'User-Agent': random.choice(self.user_agents),
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'ru-RU,ru;q=0.9',
-            'DNT': '1',
-        }
+        return random.choice(self._header_variants)
 
     async def search(self, query: str, num_results: int = 5) -> list:
         """Основной метод поиска"""
         try:
             logger.info(f"🔍 Web поиск: '{query[:50]}'...")
 
-            # Пробуем DuckDuckGo Lite (самый стабильный)
-            results = await self._search_ddg_lite(query)
-            if results:
-                logger.info(f"✅ DuckDuckGo: найдено {len(results)}")
-                return results[:num_results]
-
-            # Fallback: Bing
-            logger.debug("🔍 Fallback на Bing...")
-            results = await self._search_bing(query)
-            if results:
-                logger.info(f"✅ Bing: найдено {len(results)}")
-                return results[:num_results]
-
-            # Fallback: Google
-            logger.debug("🔍 Fallback на Google...")
-            results = await self._search_google(query)
-            if results:
-                logger.info(f"✅ Google: найдено {len(results)}")
-                return results[:num_results]
+            # Все движки стартуют одновременно - берём первый непустой результат
+            engines = {
+                "DuckDuckGo": self._search_ddg_lite,
+                "Bing": self._search_bing,
+                "Google": self._search_google,
+            }
+            tasks = {
+                asyncio.create_task(self._limited(engine, search_fn, query)): engine
+                for engine, search_fn in engines.items()
+            }
+            pending = set(tasks)
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        results = task.result()
+                        if results:
+                            logger.info(f"✅ {tasks[task]}: найдено {len(results)}")
+                            return results[:num_results]
+                        logger.debug("🔍 %s: пусто, жду остальные...", tasks[task])
+            finally:
+                # Проигравшие движки больше не нужны
+                for task in pending:
+                    task.cancel()
 
             logger.warning(f"⚠️ Результаты не найдены")
             return []
@@ -73,38 +153,36 @@ class WebSearchService:
             url = "https://lite.duckduckgo.com/lite/"
             data = {'q': query}
             
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.post(url, data=data, headers=self._get_headers()) as response:
-                    if response.status != 200:
-                        return []
-
-                    html = await response.text()
-                    soup = BeautifulSoup(html, 'html.parser')
-                    
-                    results = []
-                    for row in soup.find_all('tr')[1:]:  # Пропускаем заголовок
-                        try:
-                            cells = row.find_all('td')
-                            if len(cells) >= 2:
-                                link = cells[0].find('a')
-                                if link:
-                                    title = link.text.strip()
-                                    url = link.get('href', '')
-                                    snippet = cells[1].text.strip() if len(cells) > 1 else ''
-                                    
-                                    if title and url and len(snippet) > 20:
-                                        results.append({
-                                            'title': title,
-                                            'url': url,
-                                            'snippet': snippet
-                                        })
-                        except:
-                            continue
-
-                    return results[:self.max_results]
+            html = await self._fetch("POST", url, data=data)
+            if html is None:
+                return []
+
+            soup = BeautifulSoup(html, 'lxml')
+                
+            results = []
+            for row in _ROW_SELECTOR.select(soup):
+                try:
+                    cells = row.find_all('td')
+                    if len(cells) >= 2:
+                        link = cells[0].find('a')
+                        if link:
+                            title = link.text.strip()
+                            url = link.get('href', '')
+                            snippet = cells[1].text.strip() if len(cells) > 1 else ''
+                                
+                            if title and url and len(snippet) > 20:
+                                results.append({
+                                    'title': title,
+                                    'url': url,
+                                    'snippet': snippet
+                                })
+                except:
+                    continue
+
+            return results[:self.max_results]
 
         except Exception as e:
-            logger.debug(f"🔍 DuckDuckGo: {e}")
+            logger.debug("🔍 DuckDuckGo: %s", e)
             return []
 
     async def _search_bing(self, query: str) -> list:
@@ -112,31 +190,32 @@ class WebSearchService:
         try:
             url = f"https://www.bing.com/search?q={quote_plus(query)}"
             
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.get(url, headers=self._get_headers()) as response:
-                    html = await response.text()
-                    soup = BeautifulSoup(html, 'html.parser')
-                    
-                    results = []
-                    for item in soup.select('li.b_algo')[:self.max_results]:
-                        try:
-                            h2 = item.find('h2')
-                            link = h2.find('a') if h2 else None
-                            snippet = item.find('p')
-                            
-                            if link and snippet:
-                                results.append({
-                                    'title': link.text.strip(),
-                                    'url': link.get('href', ''),
-                                    'snippet': snippet.text.strip()
-                                })
-                        except:
-                            continue
-
-                    return results
+            html = await self._fetch("GET", url)
+            if html is None:
+                return []
+
+            soup = BeautifulSoup(html, 'lxml')
+                
+            results = []
+            for item in _BING_SELECTOR.select(soup, limit=self.max_results):
+                try:
+                    h2 = item.find('h2')
+                    link = h2.find('a') if h2 else None
+                    snippet = item.find('p')
+                        
+                    if link and snippet:
+                        results.append({
+                            'title': link.text.strip(),
+                            'url': link.get('href', ''),
+                            'snippet': snippet.text.strip()
+                        })
+                except:
+                    continue
+
+            return results
 
         except Exception as e:
-            logger.debug(f"🔍 Bing: {e}")
+            logger.debug("🔍 Bing: %s", e)
             return []
 
     async def _search_google(self, query: str) -> list:
@@ -144,32 +223,33 @@ class WebSearchService:
         try:
             url = f"https://www.google.com/search?q={quote_plus(query)}"
             
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.get(url, headers=self._get_headers()) as response:
-                    html = await response.text()
-                    soup = BeautifulSoup(html, 'html.parser')
-                    
-                    results = []
-                    for g in soup.select('div.g')[:self.max_results]:
-                        try:
-                            link = g.find('a')
-                            h3 = g.find('h3')
+            html = await self._fetch("GET", url)
+            if html is None:
+                return []
+
+            soup = BeautifulSoup(html, 'lxml')
+                
+            results = []
+            for g in _GOOGLE_SELECTOR.select(soup, limit=self.max_results):
+                try:
+                    link = g.find('a')
+                    h3 = g.find('h3')
+                        
+                    if link and h3:
+                        snippet_div = _GOOGLE_SNIPPET_SELECTOR.select_one(g)
+                        snippet = snippet_div.text.strip() if snippet_div else ''
                             
-                            if link and h3:
-                                snippet_div = g.select_one('div.s, span.st')
-                                snippet = snippet_div.text.strip() if snippet_div else ''
-                                
-                                if snippet and len(snippet) > 20:
-                                    results.append({
-                                        'title': h3.text.strip(),
-                                        'url': link.get('href', ''),
-                                        'snippet': snippet
-                                    })
-                        except:
-                            continue
+                        if snippet and len(snippet) > 20:
+                            results.append({
+                                'title': h3.text.strip(),
+                                'url': link.get('href', ''),
+                                'snippet': snippet
+                            })
+                except:
+                    continue
 
-                    return results
+            return results
 
         except Exception as e:
-            logger.debug(f"🔍 Google: {e}")
+            logger.debug("🔍 Google: %s", e)
             return []
\ No newline at end of file
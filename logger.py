@@ -8,8 +8,11 @@
 
 """
 
+import atexit
 import logging
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
 from config import LOG_LEVEL, LOG_FORMAT, LOG_FILE
 
 # ANSI цвета для консоли
@@ -34,14 +37,15 @@ class _ColoredFormatter(logging.Formatter):
     }
     
     def format(self, record):
-        emoji = self.EMOJIS.get(record.levelname, '•')
-        color = self.COLORS.get(record.levelname, '')
-        reset = self.COLORS['RESET']
-        
-        formatted = f"[{record.asctime}] {emoji} {record.getMessage()}"
-        formatted = f"{color}{formatted}{reset}"
-        
-        return formatted
+        prefix = _LEVEL_PREFIX.get(record.levelname, '• ')
+        return f"{prefix}[{self.formatTime(record)}] {record.getMessage()}{_RESET}"
+
+# Префикс (цвет + смайлик) для каждого уровня считается один раз при импорте
+_LEVEL_PREFIX = {
+    level: f"{_ColoredFormatter.COLORS[level]}{emoji} "
+    for level, emoji in _ColoredFormatter.EMOJIS.items()
+}
+_RESET = _ColoredFormatter.COLORS['RESET']
 
 # Создаём корневой логгер
 root_logger = logging.getLogger()
@@ -52,14 +56,19 @@ file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8')
 file_handler.setLevel(LOG_LEVEL)
 file_formatter = logging.Formatter(LOG_FORMAT)
 file_handler.setFormatter(file_formatter)
-root_logger.addHandler(file_handler)
 
 # Обработчик для КОНСОЛИ (с цветами и смайликами)
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(LOG_LEVEL)
 console_formatter = _ColoredFormatter(LOG_FORMAT)
 console_handler.setFormatter(console_formatter)
-root_logger.addHandler(console_handler)
+
+# Запись в файл/консоль идёт в фоновом потоке - event loop только кладёт запись в очередь
+log_queue = queue.Queue(-1)
+root_logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)  # Дописать оставшиеся записи при выходе
 
 def get_logger(name: str) -> logging.Logger:
     """Получить логгер для модуля"""
@@ -18,6 +18,12 @@ from logger import get_logger
 
 logger = get_logger(__name__)
 
+# uvloop - event loop на libuv (быстрее стандартного); на Windows недоступен
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 def main():
     """Главная функция запуска бота (СИНХРОННАЯ)"""
     logger.info("✅ Запуск ASYNC RAG Bot...")
@@ -41,23 +47,6 @@ def main():
         logger.info("✅ DatabaseManager инициализирована")
         db = DatabaseManager(embeddings_service=embedding)
 
-        # Опционально: очистить старые документы
-        if DB_AUTO_CLEANUP:
-            logger.info(f"🧹 Очистка документов (старше {DB_CLEANUP_DAYS} дней)...")
-            try:
-                # Просто выполняем без async, так как это разовая операция при старте
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                deleted = loop.run_until_complete(
-                    db.delete_old_documents(days=DB_CLEANUP_DAYS)
-                )
-                loop.close()
-                
-                if deleted > 0:
-                    logger.info(f"✅ Удалено {deleted} документов")
-            except Exception as e:
-                logger.warning(f"⚠️ Ошибка очистки: {e}")
-
         # 4. RAG Pipeline с ASYNC поддержкой
         logger.info("✅ RAG Pipeline инициализирована")
         rag = RAGPipeline(llm, embedding=embedding, db=db)
@@ -71,7 +60,31 @@ def main():
         # ════════════════════════════════════════════════════════════════════
 
         logger.info("✅ Telegram Bot инициализирован")
-        app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+
+        async def on_startup(application: Application):
+            """Разовые async задачи при старте - в event loop бота, без отдельного loop"""
+            # Опционально: очистить старые документы
+            if DB_AUTO_CLEANUP:
+                logger.info(f"🧹 Очистка документов (старше {DB_CLEANUP_DAYS} дней)...")
+                try:
+                    deleted = await db.delete_old_documents(days=DB_CLEANUP_DAYS)
+                    if deleted > 0:
+                        logger.info(f"✅ Удалено {deleted} документов")
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка очистки: {e}")
+
+        async def on_shutdown(application: Application):
+            """Дописываем очередь в БД и закрываем HTTP сессии внутри event loop бота"""
+            await rag.close()
+            await llm.close()
+
+        app = (
+            Application.builder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
 
         # Добавляем сервисы в bot_data
         app.bot_data['llm'] = llm
@@ -89,12 +102,19 @@ def main():
         logger.info(f"📚 Документов в БД: {db_stats['total_documents']}")
         logger.info("═" * 70)
 
-        # (Application сам управляет asyncio event loop внутри)
+        # (Application сам управляет asyncio event loop внутри - берёт текущий loop потока)
+        if uvloop is not None:
+            asyncio.set_event_loop(uvloop.new_event_loop())
+            logger.info("⚡ Event loop: uvloop")
+
         app.run_polling(
             allowed_updates=["message", "callback_query"],
             drop_pending_updates=True
         )
 
+        # Сохраняем кэш embeddings для следующего запуска
+        embedding.save_cache()
+
     except KeyboardInterrupt:
         logger.info("⛔ Бот остановлен (Ctrl+C)")
     except Exception as e:
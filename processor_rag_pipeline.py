@@ -6,17 +6,85 @@ RAG Pipeline - обработка запросов с ПАРАЛЛЕЛЬНЫМ 
 """
 
 import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
 
 from core_llm_service import LLMService
 from core_database_manager import DatabaseManager
 from core_embeddings_service import EmbeddingsService
 from core_web_search_service import WebSearchService
-from config import MODE_CONFIGS
+from config import (
+    MODE_CONFIGS,
+    ModeConfig,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL,
+    SEMANTIC_CACHE_SIZE,
+    CHROMA_SIMILARITY_THRESHOLD,
+    DB_CONFIDENT_SIMILARITY,
+    DB_SUFFICIENT_CONTEXT_CHARS,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_FILE,
+    WEB_CACHE_SIZE,
+    WEB_CACHE_TTL,
+)
+from core_cache import SQLiteCache, TTLCache
 from logger import get_logger
 
 logger = get_logger(__name__)
 
+# Нормализация сниппета для дедупликации: номер в списке результатов и пунктуация не важны
+_SNIPPET_NUMBER_RE = re.compile(r"^\d+\.\s*")
+_NON_WORD_RE = re.compile(r"\W+")
+
+
+def _snippet_hash(text: str) -> bytes:
+    """Хэш нормализованного текста сниппета"""
+    normalized = _NON_WORD_RE.sub("", _SNIPPET_NUMBER_RE.sub("", text).lower())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest()
+
+
 class RAGPipeline:
+    # Фоновое сохранение web-сниппетов копится и уходит в БД пачками
+    SAVE_BATCH_SIZE = 32
+    SAVE_FLUSH_INTERVAL = 0.2  # секунды
+    SEEN_SNIPPETS_MAX = 10000
+    # Web сниппеты с меньшей cosine similarity к запросу не попадают в контекст
+    WEB_MIN_SIMILARITY = 0.35
+
+    # Шаблоны промптов по режимам (неизвестный режим -> detailed)
+    _PROMPT_TEMPLATES = {
+        "short": (
+            "Дай краткий ответ (2-3 предложения).\n"
+            "Язык: РУССКИЙ.\n"
+            "\n"
+            "Информация:\n"
+            "{context}\n\nВопрос: {query}\n\nОтвет:"
+        ),
+        "default": (
+            "Дай полный ответ на вопрос.\n"
+            "Используй информацию ниже. Структурируй ответ.\n"
+            "Объем: 500-1000 слов.\n"
+            "Язык: РУССКИЙ.\n"
+            "\n"
+            "Информация:\n"
+            "{context}\n\nВопрос: {query}\n\nОтвет:"
+        ),
+        "detailed": (
+            "Дай ОЧЕНЬ подробный ответ.\n"
+            "Объясни детали, приведи примеры.\n"
+            "Объем: 1500+ слов.\n"
+            "Язык: РУССКИЙ.\n"
+            "\n"
+            "Информация:\n"
+            "{context}\n\nВопрос: {query}\n\nОтвет:"
+        ),
+    }
+
     def __init__(
         self,
         llm: LLMService,
@@ -27,43 +95,108 @@ class RAGPipeline:
         self.embedding = embedding
         self.db = db
         self.web_search = WebSearchService()
-
-    async def process(self, query: str, user_mode: str = None) -> str:
-        """Основной метод обработки запроса"""
+        # Сырые результаты поиска: (запрос без регистра, кол-во) -> список
+        self._web_cache = TTLCache(maxsize=WEB_CACHE_SIZE, ttl=WEB_CACHE_TTL)
+
+        # Постоянный кэш ответов: точное совпадение (режим, нормализованный запрос)
+        self.response_cache = None
+        if RESPONSE_CACHE_ENABLED:
+            self.response_cache = SQLiteCache(RESPONSE_CACHE_FILE, ttl=RESPONSE_CACHE_TTL)
+            purged = self.response_cache.purge_expired()
+            if purged:
+                logger.info("🧹 Кэш ответов: удалено %d устаревших записей", purged)
+
+        # Семантический кэш ответов: нормированные embeddings запросов + (ответ, время, режим)
+        # Матрица (SEMANTIC_CACHE_SIZE, dim) выделяется один раз и заполняется по кругу
+        self._sem_cache_vecs = None
+        self._sem_cache_entries = [None] * SEMANTIC_CACHE_SIZE
+        self._sem_cache_count = 0  # Сколько строк заполнено
+        self._sem_cache_pos = 0    # Куда пишем следующую запись (самая старая при переполнении)
+
+        # Очередь сохранения в БД и её единственный потребитель (создаются в event loop)
+        self._save_queue = None
+        self._save_worker = None
+
+        # Хэши недавно сохранённых сниппетов (ограниченный LRU set) - повторы не эмбеддим
+        self._seen_snippets = OrderedDict()
+
+    async def process(self, query: str, user_mode: str = None, on_chunk=None) -> str:
+        """
+        Основной метод обработки запроса.
+        on_chunk - async callback(фрагмент): ответ LLM по мере генерации (ответ из кэша не стримится)
+        """
         if not query or not query.strip():
             return "Пустой запрос. Напиши что-нибудь!"
 
         mode = user_mode or 'default'
         mode_config = MODE_CONFIGS.get(mode, MODE_CONFIGS['default'])
 
-        logger.info(f"🔄 [{mode.upper()}] Processing: {query[:50]}...")
+        logger.info("🔄 [%s] Processing: %.50s...", mode.upper(), query)
+
+        # 0. ТОЧНЫЙ КЭШ (тот же запрос в том же режиме -> готовый ответ без embeddings и LLM)
+        cache_key = self._response_cache_key(query, mode)
+        if self.response_cache:
+            try:
+                cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+            except Exception as e:
+                # Сбой кэша (блокировка, диск) = промах, запрос обрабатываем как обычно
+                logger.error(f"Response cache read error: {e}")
+                cached = None
+            if cached:
+                logger.info("⚡ Response cache HIT [%s]", mode.upper())
+                return cached
+
+        # Один embedding запроса - для семантического кэша, поиска в БД и ранжирования web
+        q_vec = await self._embed_query(query)
+
+        # 0a. СЕМАНТИЧЕСКИЙ КЭШ (перефразированный повтор -> готовый ответ)
+        cached = self._semantic_cache_lookup(q_vec, mode)
+        if cached:
+            return cached
 
         # 1. ПАРАЛЛЕЛЬНЫЙ ПОИСК (Web + DB одновременно)
-        num_web_results = mode_config.get('web_search_results', 5)
+        num_web_results = mode_config.web_search_results
 
-        web_task = asyncio.create_task(self._search_web(query, num_results=num_web_results))
-        db_task = asyncio.create_task(self._search_database(query))
+        web_task = asyncio.create_task(self._search_web(query, num_results=num_web_results, q_emb=q_vec))
+        db_task = asyncio.create_task(self._search_database(q_vec))
 
-        results = await asyncio.gather(web_task, db_task, return_exceptions=True)
-
-        web_results = results[0] if not isinstance(results[0], Exception) else ""
-        db_results = results[1] if not isinstance(results[1], Exception) else ""
-
-        if isinstance(results[0], Exception):
-            logger.error(f"Web search error: {results[0]}")
-        if isinstance(results[1], Exception):
-            logger.error(f"DB search error: {results[1]}")
+        # 1a. БЫСТРЫЙ ПУТЬ: локальная БД отвечает раньше web - ждём её первой
+        # (web тем временем уже идёт); если БД хватает - web отменяем
+        try:
+            db_results, db_score = await db_task
+        except Exception as e:
+            logger.error(f"DB search error: {e}")
+            db_results, db_score = "", 0.0
+
+        if db_results and (
+            db_score >= DB_CONFIDENT_SIMILARITY
+            or (len(db_results) > DB_SUFFICIENT_CONTEXT_CHARS and db_score >= CHROMA_SIMILARITY_THRESHOLD)
+        ):
+            web_task.cancel()
+            web_results = ""
+            logger.info(
+                "⚡ DB hit (similarity=%.3f, %d символов), web поиск отменён", db_score, len(db_results)
+            )
+        else:
+            try:
+                web_results = await web_task
+            except Exception as e:
+                logger.error(f"Web search error: {e}")
+                web_results = ""
 
         # 2. ФОРМИРОВАНИЕ КОНТЕКСТА
-        final_context = ""
+        context_parts = []
 
         if web_results:
-            final_context += "=== ИНФОРМАЦИЯ ИЗ ИНТЕРНЕТА ===\n\n"
-            final_context += web_results + "\n\n"
+            context_parts.append("=== ИНФОРМАЦИЯ ИЗ ИНТЕРНЕТА ===\n\n")
+            context_parts.append(web_results)
+            context_parts.append("\n\n")
 
         if db_results and len(db_results) > 50:
-            final_context += "=== ИЗ БАЗЫ ЗНАНИЙ ===\n\n"
-            final_context += db_results
+            context_parts.append("=== ИЗ БАЗЫ ЗНАНИЙ ===\n\n")
+            context_parts.append(db_results)
+
+        final_context = "".join(context_parts)
 
         if not final_context:
             logger.warning("No context found from Web or DB")
@@ -71,126 +204,258 @@ class RAGPipeline:
 
         # 3. ФОНОВОЕ СОХРАНЕНИЕ
         if web_results:
-            asyncio.create_task(self._add_web_results_to_db(web_results, query))
+            self._add_web_results_to_db(web_results, query)
 
         # 4. ГЕНЕРАЦИЯ ОТВЕТА (просто отправляем, БЕЗ ВАЛИДАЦИИ)
+        # Длина промпта = время prompt eval в Ollama - режем контекст до бюджета режима
+        final_context = self._truncate_to_budget(final_context, mode_config.context_chars)
+
         response = await self._generate_answer(
             query=query,
             context=final_context,
             mode=mode,
-            mode_config=mode_config
+            mode_config=mode_config,
+            on_chunk=on_chunk,
         )
 
+        if response and not response.startswith("❌"):
+            self._semantic_cache_store(q_vec, mode, response)
+            if self.response_cache:
+                try:
+                    await asyncio.to_thread(self.response_cache.set, cache_key, response)
+                except Exception as e:
+                    # Ответ уже готов - ошибка записи в кэш не должна его потерять
+                    logger.error(f"Response cache write error: {e}")
+
         return response
 
-    async def _search_database(self, query: str) -> str:
-        """Поиск в БД в отдельном потоке"""
+    @staticmethod
+    def _response_cache_key(query: str, mode: str) -> str:
+        """Ключ точного кэша: режим + запрос без регистра и крайних пробелов"""
+        return hashlib.blake2b(f"{mode}|{query.strip().lower()}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _truncate_to_budget(text: str, max_chars: int) -> str:
+        """Оставить начало (70% бюджета, самое релевантное) и конец (30%) текста"""
+        if len(text) <= max_chars:
+            return text
+
+        head = int(max_chars * 0.7)
+        tail = max_chars - head
+        logger.info("✂️ Контекст сокращён: %d -> %d символов", len(text), max_chars)
+        return f"{text[:head]}\n...\n{text[-tail:]}"
+
+    def _semantic_cache_lookup(self, q_vec, mode: str):
+        """Найти ответ на похожий запрос в том же режиме (cosine >= порога, не старше TTL)"""
+        if q_vec is None or not self._sem_cache_count or q_vec.shape[0] != self._sem_cache_vecs.shape[1]:
+            return None
+
+        sims = self._sem_cache_vecs[:self._sem_cache_count] @ q_vec
+        candidates = np.flatnonzero(sims >= SEMANTIC_CACHE_THRESHOLD)
+        now = time.time()
+
+        for i in candidates[np.argsort(-sims[candidates])]:
+            response, created_at, entry_mode = self._sem_cache_entries[i]
+            if entry_mode == mode and now - created_at < SEMANTIC_CACHE_TTL:
+                logger.info("⚡ Semantic cache HIT [%s] (similarity=%.3f)", mode.upper(), sims[i])
+                return response
+
+        return None
+
+    def _semantic_cache_store(self, q_vec, mode: str, response: str) -> None:
+        """Запомнить ответ (при переполнении перезаписывается самая старая строка)"""
+        if q_vec is None:
+            return
+
+        if self._sem_cache_vecs is None or self._sem_cache_vecs.shape[1] != q_vec.shape[0]:
+            # Первая запись (или сменилась размерность модели) - выделяем матрицу заново
+            self._sem_cache_vecs = np.zeros((SEMANTIC_CACHE_SIZE, q_vec.shape[0]), dtype=np.float32)
+            self._sem_cache_count = 0
+            self._sem_cache_pos = 0
+
+        pos = self._sem_cache_pos
+        self._sem_cache_vecs[pos] = q_vec
+        self._sem_cache_entries[pos] = (response, time.time(), mode)
+        self._sem_cache_pos = (pos + 1) % SEMANTIC_CACHE_SIZE
+        self._sem_cache_count = min(self._sem_cache_count + 1, SEMANTIC_CACHE_SIZE)
+
+    async def _embed_query(self, query: str):
+        """L2-нормированный embedding запроса, считается в пуле потоков (None при ошибке)"""
         try:
-            loop = asyncio.get_event_loop()
-            results_text = await loop.run_in_executor(
-                None,
-                lambda: self.db.search(query, top_k=5)
-            )
-            return results_text if results_text else ""
+            vec = (await asyncio.to_thread(self.embedding.embed, [query.strip()]))[0]
+            norm = np.linalg.norm(vec)
+            return vec / norm if norm else None
+        except Exception as e:
+            logger.error(f"Query embedding error: {e}")
+            return None
+
+    async def _search_database(self, q_emb) -> tuple:
+        """Поиск в БД по готовому embedding -> (текст, лучшая similarity)"""
+        try:
+            return await self.db.search_by_embedding(q_emb, top_k=5)
         except Exception as e:
             logger.error(f"DB search error: {e}")
-            return ""
+            return "", 0.0
+
+    async def _rerank_web_results(self, q_emb, results: list) -> list:
+        """Упорядочить сниппеты по cosine similarity к запросу, отбросив нерелевантные"""
+        if q_emb is None or not q_emb.any() or len(results) < 2:
+            return results
 
-    async def _search_web(self, query: str, num_results: int = 5) -> str:
-        """Поиск в интернете"""
+        texts = [f"{r.get('title', '')}\n{r.get('snippet', '')}" for r in results]
         try:
-            results = await self.web_search.search(query, num_results=num_results)
-            if not results:
-                return ""
+            vecs = await asyncio.to_thread(self.embedding.embed, texts)
+        except Exception as e:
+            # Без embeddings оставляем порядок поисковика
+            logger.warning(f"⚠️ Web rerank skipped: {e}")
+            return results
+
+        norms = np.linalg.norm(vecs, axis=1) * np.linalg.norm(q_emb)
+        sims = np.divide(vecs @ q_emb, norms, out=np.zeros(len(texts), dtype=np.float32), where=norms > 0)
+        order = np.argsort(-sims)
+
+        ranked = [results[i] for i in order if sims[i] >= self.WEB_MIN_SIMILARITY]
+        if len(ranked) < len(results):
+            logger.debug("Dropped %d low similarity web snippets", len(results) - len(ranked))
+        # Хотя бы один результат оставляем - лучше слабый контекст, чем никакого
+        return ranked or [results[order[0]]]
+
+    async def _search_web(self, query: str, num_results: int = 5, q_emb=None) -> str:
+        """Поиск в интернете (сниппеты ранжируются по близости к запросу)"""
+        try:
+            cache_key = (query.strip().lower(), num_results)
+            results = self._web_cache.get(cache_key)
+            if results is None:
+                results = await self.web_search.search(query, num_results=num_results)
+                if not results:
+                    return ""
+                self._web_cache.set(cache_key, results)
+            else:
+                logger.info("⚡ Web cache HIT (%d результатов)", len(results))
 
-            context = ""
+            results = await self._rerank_web_results(q_emb, results)
+
+            parts = []
             for i, result in enumerate(results, 1):
                 title = result.get('title', '').strip()
                 snippet = result.get('snippet', '').strip()
                 url = result.get('url', '')
 
                 if title and snippet:
-                    context += f"{i}. {title}\n{snippet}\n"
+                    parts.append(f"{i}. {title}\n{snippet}\n")
                 if url:
-                    context += f"Источник: {url}\n"
-                context += "\n"
+                    parts.append(f"Источник: {url}\n")
+                parts.append("\n")
 
-            return context.strip()
+            return "".join(parts).strip()
         except Exception as e:
             logger.error(f"Web search error: {e}")
             return ""
 
-    async def _add_web_results_to_db(self, web_context: str, query: str) -> None:
-        """Фоновое сохранение результатов в БД"""
+    def _iter_new_snippets(self, web_context: str):
+        """Новые (ещё не сохранённые) сниппеты веб-контекста -> документы для БД"""
+        for part in web_context.split('\n\n'):
+            cleaned = part.strip()
+            if len(cleaned) <= 50:
+                continue
+
+            key = _snippet_hash(cleaned)
+            if key in self._seen_snippets:
+                self._seen_snippets.move_to_end(key)
+                continue
+            self._seen_snippets[key] = None
+            if len(self._seen_snippets) > self.SEEN_SNIPPETS_MAX:
+                self._seen_snippets.popitem(last=False)
+
+            yield {'text': cleaned}
+
+    def _add_web_results_to_db(self, web_context: str, query: str) -> None:
+        """Фоновое сохранение результатов в БД (через очередь пакетной записи)"""
         try:
-            parts = web_context.split('\n\n')
-            documents = []
-            
-            for part in parts:
-                cleaned = part.strip()
-                if len(cleaned) > 50:
-                    documents.append({'text': cleaned})
-
-            if documents:
-                await self.db.add_documents(documents, source="web_auto")
-                logger.info(f"💾 Saved {len(documents)} snippets to DB")
+            for doc in self._iter_new_snippets(web_context):
+                if self._save_queue is None:
+                    self._save_queue = asyncio.Queue()
+                    self._save_worker = asyncio.create_task(self._save_loop())
+
+                self._save_queue.put_nowait(doc)
+        except Exception as e:
+            logger.error(f"Background save error: {e}")
+
+    async def _save_loop(self) -> None:
+        """
+        Потребитель очереди: ждёт SAVE_BATCH_SIZE документов или SAVE_FLUSH_INTERVAL секунд.
+        None в очереди - сигнал остановки (после записи накопленного).
+        """
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._save_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.SAVE_FLUSH_INTERVAL
+
+            while len(batch) < self.SAVE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._save_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._save_batch(batch)
+
+    async def _save_batch(self, documents: list) -> None:
+        """Одна запись в БД на пачку (embeddings считаются батчами)"""
+        try:
+            await self.db.add_documents(
+                documents, source="web_auto", batch_size=self.SAVE_BATCH_SIZE
+            )
+            logger.info("💾 Saved %d snippets to DB", len(documents))
         except Exception as e:
             logger.error(f"Background save error: {e}")
 
-    async def _generate_answer(self, query: str, context: str, mode: str, mode_config: dict) -> str:
+    async def close(self) -> None:
+        """Дописать очередь в БД и закрыть сервисы (вызывается при остановке бота)"""
+        if self._save_worker is not None:
+            self._save_queue.put_nowait(None)
+            await self._save_worker
+            self._save_queue = None
+            self._save_worker = None
+
+        await self.web_search.close()
+
+        if self.response_cache:
+            self.response_cache.close()
+
+    async def _generate_answer(
+        self, query: str, context: str, mode: str, mode_config: ModeConfig, on_chunk=None
+    ) -> str:
         """Генерация ответа через LLM"""
         try:
-            if mode == 'short':
-                prompt = self._build_short_prompt(query, context)
-            elif mode == 'default':
-                prompt = self._build_default_prompt(query, context)
-            else:
-                prompt = self._build_detailed_prompt(query, context)
+            prompt = self._build_prompt(mode, query, context)
 
-            response = self.llm.generate(
+            response = await self.llm.generate(
                 prompt=prompt,
                 context=context,
-                mode=mode
+                mode=mode,
+                on_chunk=on_chunk,
             )
             
+            # Пустой ответ = LLM недоступна или поток оборвался (частичный текст не отдаём и не кэшируем)
+            if not response:
+                return "❌ Не удалось получить ответ от модели. Попробуй ещё раз."
+            
             return response
         except Exception as e:
             logger.error(f"LLM generation error: {e}")
             return f"❌ Ошибка: {str(e)}"
 
-    def _build_short_prompt(self, query: str, context: str) -> str:
-        return f"""Дай краткий ответ (2-3 предложения).
-Язык: РУССКИЙ.
-
-Информация:
-{context}
-
-Вопрос: {query}
-
-Ответ:"""
-
-    def _build_default_prompt(self, query: str, context: str) -> str:
-        return f"""Дай полный ответ на вопрос.
-Используй информацию ниже. Структурируй ответ.
-Объем: 500-1000 слов.
-Язык: РУССКИЙ.
-
-Информация:
-{context}
-
-Вопрос: {query}
-
-Ответ:"""
-
-    def _build_detailed_prompt(self, query: str, context: str) -> str:
-        return f"""Дай ОЧЕНЬ подробный ответ.
-Объясни детали, приведи примеры.
-Объем: 1500+ слов.
-Язык: РУССКИЙ.
-
-Информация:
-{context}
-
-Вопрос: {query}
-
-Ответ:"""
+    def _build_prompt(self, mode: str, query: str, context: str) -> str:
+        template = self._PROMPT_TEMPLATES.get(mode, self._PROMPT_TEMPLATES["detailed"])
+        return template.format(context=context, query=query)
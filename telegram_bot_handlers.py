@@ -5,16 +5,19 @@ HANDLERS - Обработчики Telegram команд и сообщений
 """
 
 import asyncio
+import time
 import traceback
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 from telegram.constants import ChatAction
-from telegram_bot_message_formatter import format_response, clean_response_for_telegram
+from telegram_bot_message_formatter import prepare_for_telegram
 from telegram_bot_keyboards import get_persistent_keyboard
 from logger import get_logger
 
 logger = get_logger(__name__)
 
 TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+# Черновик ответа правим не чаще раза в STREAM_EDIT_INTERVAL секунд (лимиты Bot API на edit)
+STREAM_EDIT_INTERVAL = 1.5
 
 HELP_TEXT = """🤖 RAG Bot - Справка
 
@@ -43,6 +46,23 @@ HELP_TEXT = """🤖 RAG Bot - Справка
 /help - эта справка
 """
 
+# Кнопки клавиатуры: текст -> (режим, ответ); режим None - справка
+_BUTTON_ACTIONS = {
+    "📚 Справка": (None, None),
+    "🟢 Кратко": (
+        "short",
+        "🟢 Режим Кратко активирован.\n\nТеперь ты получишь ответы 300-500 слов.",
+    ),
+    "🟡 Нормально": (
+        "default",
+        "🟡 Режим Нормально активирован.\n\nТеперь ты получишь ответы 800-1000 слов.",
+    ),
+    "🔴 Подробно": (
+        "detailed",
+        "🔴 Режим Подробно активирован.\n\nТеперь ты получишь ответы 1500-2500 слов с полными деталями.",
+    ),
+}
+
 
 async def send_long_message(message, text: str, reply_markup=None):
     """
@@ -53,29 +73,98 @@ async def send_long_message(message, text: str, reply_markup=None):
     if not text or len(text.strip()) == 0:
         return
     
-    chunk_size = 4096
+    parts = [
+        text[i:i + TELEGRAM_MAX_MESSAGE_LENGTH]
+        for i in range(0, len(text), TELEGRAM_MAX_MESSAGE_LENGTH)
+    ]
     
-    for i in range(0, len(text), chunk_size):
-        part = text[i:i + chunk_size]
+    # Части отправляем строго по очереди: параллельные запросы Telegram
+    # может доставить в другом порядке, и ответ перемешается
+    for index, part in enumerate(parts):
         try:
             # БЕЗ parse_mode - только plain text!
             await message.reply_text(
                 part,
-                reply_markup=reply_markup if i == 0 else None
+                reply_markup=reply_markup if index == 0 else None
             )
         except Exception as e:
             logger.error(f"❌ Ошибка отправки сообщения: {e}")
 
 
-async def send_typing_status(update, interval: float = 5.0):
+class StreamingReply:
+    """
+    Постепенный вывод ответа: первое сообщение-черновик правится по мере генерации,
+    в конце заменяется готовым ответом (остаток длинного ответа - отдельными сообщениями).
+    """
+
+    def __init__(self, message):
+        self.message = message  # Сообщение пользователя - на него отвечаем
+        self.draft = None       # Наше сообщение с черновиком
+        self._chunks = []
+        self._shown = ""
+        self._last_edit = 0.0
+
+    async def feed(self, chunk: str) -> None:
+        """Новый фрагмент ответа (callback для RAGPipeline.process)"""
+        self._chunks.append(chunk)
+
+        now = time.monotonic()
+        if now - self._last_edit < STREAM_EDIT_INTERVAL:
+            return
+        self._last_edit = now
+
+        text = prepare_for_telegram("".join(self._chunks), max_length=TELEGRAM_MAX_MESSAGE_LENGTH)
+        # Черновик - только первое сообщение; дальше ждём готовый ответ
+        if not text or len(text) > TELEGRAM_MAX_MESSAGE_LENGTH - 2:
+            return
+        text += " …"
+
+        try:
+            if self.draft is None:
+                self.draft = await self.message.reply_text(text)
+            else:
+                await self.draft.edit_text(text)
+            self._shown = text
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить черновик ответа: {e}")
+
+    async def finish(self, text: str, reply_markup=None) -> None:
+        """Показать готовый ответ (уже подготовленный prepare_for_telegram)"""
+        if self.draft is None:
+            await send_long_message(self.message, text, reply_markup=reply_markup)
+            return
+
+        # Клавиатура уже показана при /start и остаётся - у правки её нет
+        first = text[:TELEGRAM_MAX_MESSAGE_LENGTH] or "❌ Пустой ответ"
+        if first != self._shown:
+            try:
+                await self.draft.edit_text(first)
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки сообщения: {e}")
+
+        await send_long_message(self.message, text[TELEGRAM_MAX_MESSAGE_LENGTH:])
+
+
+async def send_typing_status(
+    update,
+    interval: float = 5.0,
+    slow_interval: float = 8.0,
+    slow_after: float = 30.0,
+):
     """
     Отправляет статус "печатает" каждые `interval` секунд.
     Используется в фоне для долгих операций.
+    После `slow_after` секунд переходит на `slow_interval` - меньше запросов
+    к Bot API при долгой генерации (лимит ~30 запросов/с на бота).
     """
+    elapsed = 0.0
     try:
         while True:
             await update.message.chat.send_action(ChatAction.TYPING)
             await asyncio.sleep(interval)
+            elapsed += interval
+            if elapsed >= slow_after:
+                interval = slow_interval
     except asyncio.CancelledError:
         pass
     except Exception as e:
@@ -97,7 +186,7 @@ async def start(update, context):
             reply_markup=get_persistent_keyboard()
         )
         
-        logger.info(f"✅ Пользователь {update.effective_user.id} запустил /start")
+        logger.info("✅ Пользователь %s запустил /start", update.effective_user.id)
     except Exception as e:
         logger.error(f"❌ Ошибка /start: {e}")
         try:
@@ -113,7 +202,7 @@ async def help_command(update, context):
             HELP_TEXT,
             reply_markup=get_persistent_keyboard()
         )
-        logger.info(f"ℹ️ Справка отправлена пользователю {update.effective_user.id}")
+        logger.info("ℹ️ Справка отправлена пользователю %s", update.effective_user.id)
     except Exception as e:
         logger.error(f"❌ Ошибка /help: {e}")
 
@@ -123,37 +212,17 @@ async def handle_message(update, context):
     query = update.message.text
     
     try:
-        # ========== СПРАВКА ==========
-        if query == "📚 Справка":
-            await help_command(update, context)
-            return
-
-        # ========== СМЕНА РЕЖИМА ==========
-        if query == "🟢 Кратко":
-            context.user_data['mode'] = 'short'
-            await update.message.reply_text(
-                "🟢 Режим Кратко активирован.\n\nТеперь ты получишь ответы 300-500 слов.",
-                reply_markup=get_persistent_keyboard()
-            )
-            logger.info(f"✅ Режим SHORT включен для {update.effective_user.id}")
-            return
-
-        if query == "🟡 Нормально":
-            context.user_data['mode'] = 'default'
-            await update.message.reply_text(
-                "🟡 Режим Нормально активирован.\n\nТеперь ты получишь ответы 800-1000 слов.",
-                reply_markup=get_persistent_keyboard()
-            )
-            logger.info(f"✅ Режим DEFAULT включен для {update.effective_user.id}")
-            return
-
-        if query == "🔴 Подробно":
-            context.user_data['mode'] = 'detailed'
-            await update.message.reply_text(
-                "🔴 Режим Подробно активирован.\n\nТеперь ты получишь ответы 1500-2500 слов с полными деталями.",
-                reply_markup=get_persistent_keyboard()
-            )
-            logger.info(f"✅ Режим DETAILED включен для {update.effective_user.id}")
+        # ========== КНОПКИ КЛАВИАТУРЫ (справка / смена режима) ==========
+        action = _BUTTON_ACTIONS.get(query)
+        if action is not None:
+            mode, reply = action
+            if mode is None:
+                await help_command(update, context)
+                return
+
+            context.user_data['mode'] = mode
+            await update.message.reply_text(reply, reply_markup=get_persistent_keyboard())
+            logger.info("✅ Режим %s включен для %s", mode.upper(), update.effective_user.id)
             return
 
         # ========== ОБРАБОТКА ВОПРОСА ==========
@@ -164,7 +233,7 @@ async def handle_message(update, context):
             )
             return
 
-        logger.info(f"📨 Запрос от {update.effective_user.id}: {query[:40]}...")
+        logger.info("📨 Запрос от %s: %.40s...", update.effective_user.id, query)
 
         current_mode = context.user_data.get('mode', 'default')
         
@@ -181,28 +250,22 @@ async def handle_message(update, context):
             logger.error("❌ RAG Pipeline не инициализирована")
             return
 
-        # Получаем ответ (долгая операция)
-        response = await rag.process(query, current_mode)
-        
-        # ========== ОСТАНАВЛИВАЕМ ФОНОВЫЙ СТАТУС ==========
-        typing_task.cancel()
+        # Получаем ответ (долгая операция) - по ходу генерации правим черновик
+        reply = StreamingReply(update.message)
         try:
-            await typing_task
-        except asyncio.CancelledError:
-            pass
+            response = await rag.process(query, current_mode, on_chunk=reply.feed)
+        finally:
+            # ========== ОСТАНАВЛИВАЕМ ФОНОВЫЙ СТАТУС ==========
+            # Ждать отменённую задачу не нужно - CancelledError она гасит сама
+            typing_task.cancel()
         
         # Форматируем
-        formatted_response = format_response(response)
-        cleaned_response = clean_response_for_telegram(formatted_response)
+        cleaned_response = prepare_for_telegram(response)
 
         # Отправляем безопасно - БЕЗ parse_mode
-        await send_long_message(
-            update.message,
-            cleaned_response,
-            reply_markup=get_persistent_keyboard()
-        )
+        await reply.finish(cleaned_response, reply_markup=get_persistent_keyboard())
 
-        logger.info(f"✅ Ответ отправлен пользователю {update.effective_user.id}")
+        logger.info("✅ Ответ отправлен пользователю %s", update.effective_user.id)
 
     except Exception as e:
         logger.error(f"❌ Ошибка обработки сообщения: {e}")
@@ -5,10 +5,9 @@ KEYBOARDS - Inline и Reply клавиатуры с кнопками
 
 from telegram import ReplyKeyboardMarkup, KeyboardButton
 
-
-def get_persistent_keyboard():
-    """Постоянная клавиатура внизу экрана: режимы + справка"""
-    keyboard = [
+# Клавиатуры неизменяемы - собираем один раз при импорте
+_PERSISTENT_KB = ReplyKeyboardMarkup(
+    [
         [
             KeyboardButton("🟢 Кратко"),
             KeyboardButton("🟡 Нормально"),
@@ -17,15 +16,27 @@ def get_persistent_keyboard():
         [
             KeyboardButton("📚 Справка"),
         ],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
-
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+)
 
-def get_back_button_keyboard():
-    """Кнопка назад"""
-    keyboard = [
+_BACK_KB = ReplyKeyboardMarkup(
+    [
         [
             KeyboardButton("⬅️ Назад"),
         ],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
\ No newline at end of file
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+)
+
+
+def get_persistent_keyboard():
+    """Постоянная клавиатура внизу экрана: режимы + справка"""
+    return _PERSISTENT_KB
+
+
+def get_back_button_keyboard():
+    """Кнопка назад"""
+    return _BACK_KB
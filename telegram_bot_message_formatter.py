@@ -9,55 +9,51 @@ from logger import get_logger
 
 logger = get_logger(__name__)
 
+# Строки с техническими метаданными поиска (проверка одним проходом, без lower())
+_SKIP_RE = re.compile(r'подобие:|similarity:|результаты из|results from', re.IGNORECASE)
+# Те же строки целиком вместе с переводом строки - удаляются одним re.sub
+_SKIP_LINE_RE = re.compile(
+    r'^.*(?:подобие:|similarity:|результаты из|results from).*\n?',
+    re.IGNORECASE | re.MULTILINE,
+)
+_MULTI_NL = re.compile(r'\n{3,}')
 
-def format_response(text: str) -> str:
-    """
-    Очищает ответ для plain text отправки в Telegram.
-    Не добавляет Markdown разметку - просто удаляет мусор.
-    """
-    if not text:
-        return ""
-    
-    # Удаляем служебные метаданные
-    text = text.replace('📚 ИЗ БАЗЫ ЗНАНИЙ:', '')
-    text = text.replace('🌐 ИЗ ИНТЕРНЕТА:', '')
-    text = text.replace('Источник:', '')
-    
-    # Удаляем повторяющиеся пустые строки
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    # Удаляем странные символы
-    text = text.replace('---', '-')
-    
-    return text.strip()
-
-
-def clean_response_for_telegram(text: str, max_length: int = 4000) -> str:
+# Служебные метки удаляются, '---' сворачивается в '-' (за один проход)
+_JUNK = re.compile(r'📚 ИЗ БАЗЫ ЗНАНИЙ:|🌐 ИЗ ИНТЕРНЕТА:|Источник:|---')
+
+# Если ни одной из подстрок нет - _JUNK заведомо ничего не найдёт
+_FORMAT_MARKERS = ('📚', '🌐', 'Источник:', '---')
+
+
+def _junk_replacement(match: re.Match) -> str:
+    return '-' if match.group() == '---' else ''
+
+
+def prepare_for_telegram(text: str, max_length: int = 4000) -> str:
     """
-    Финальная очистка перед отправкой:
-    1. Удаляет технические детали
-    2. Обрезает по макс длине
-    3. НЕ добавляет Markdown
+    Готовит ответ LLM к plain text отправке в Telegram (без разбиения на строки):
+    1. Удаляет служебные метки и строки с техническими метаданными
+    2. Сворачивает повторяющиеся пустые строки
+    3. Обрезает по макс длине
+    НЕ добавляет Markdown разметку.
     """
     if not text:
         return ""
 
-    lines = text.split('\n')
-    cleaned_lines = []
-
-    for line in lines:
-        # Удаляем технические метаданные
-        if 'подобие:' in line.lower() or 'similarity:' in line.lower():
-            continue
-        if 'результаты из' in line.lower() or 'results from' in line.lower():
-            continue
-        if 'источник:' in line.lower() and 'http' in line.lower():
-            # Оставляем ссылки как есть, но без форматирования
-            line = line.replace('https://', 'https://').replace('http://', 'http://')
-        
-        cleaned_lines.append(line)
-
-    result = '\n'.join(cleaned_lines).strip()
+    # Быстрый путь: чистый ответ модели (частый случай) не гоняем через regex
+    if any(marker in text for marker in _FORMAT_MARKERS):
+        # Удаляем служебные метаданные и странные символы
+        text = _JUNK.sub(_junk_replacement, text)
+
+    # Удаляем технические метаданные (строки-источники со ссылками остаются как есть)
+    if _SKIP_RE.search(text):
+        text = _SKIP_LINE_RE.sub('', text)
+
+    # Не больше одной пустой строки подряд
+    if '\n\n\n' in text:
+        text = _MULTI_NL.sub('\n\n', text)
+
+    result = text.strip()
 
     # Обрезаем если слишком длинно
     if len(result) > max_length: